@@ -0,0 +1,96 @@
+"""ORMオブジェクト・行からスキーマへの変換速度を比較します。
+
+poetry run python -m benchmarks.converter
+"""
+import timeit
+from types import SimpleNamespace
+from typing import List
+
+import sqlalchemy as sa
+from pydantic import BaseModel
+from sqlalchemy.orm import declarative_base, relationship
+
+from sqlalchemy14 import Crud
+from sqlalchemy14.converter import get_converter, get_row_converter
+
+Base = declarative_base()
+
+
+class Parents(Base):
+    __tablename__ = "parents"
+    id = sa.Column(sa.Integer, primary_key=True)
+    name = sa.Column(sa.String)
+    email = sa.Column(sa.String)
+    age = sa.Column(sa.Integer)
+    children = relationship("Children")
+
+
+class Children(Base):
+    __tablename__ = "children"
+    id = sa.Column(sa.Integer, primary_key=True)
+    name = sa.Column(sa.String)
+    parent_id = sa.Column(sa.Integer, sa.ForeignKey("parents.id"))
+
+
+class Person(BaseModel, Crud[Parents]):
+    class Config:
+        orm_mode = True
+
+    id: int
+    name: str
+    email: str
+    age: int
+
+
+class Child(BaseModel, Crud[Children]):
+    class Config:
+        orm_mode = True
+
+    id: int
+    name: str
+    parent_id: int
+
+
+class Parent(BaseModel, Crud[Parents]):
+    class Config:
+        orm_mode = True
+
+    id: int
+    name: str
+    children: List[Child]
+
+
+def bench(name: str, func, number: int):
+    seconds = min(timeit.repeat(func, number=number, repeat=5))
+    print(f"{name:<40} {number / seconds:>12,.0f} ops/sec")
+    return seconds
+
+
+def main(number: int = 100000):
+    obj = SimpleNamespace(id=1, name="name", email="a@example.com", age=20)
+    row = (1, "name", "a@example.com", 20)
+    children = [SimpleNamespace(id=i, name="child", parent_id=1) for i in range(10)]
+    parent = SimpleNamespace(id=1, name="parent", children=children)
+
+    trusted = get_converter(Person)
+    row_trusted = get_row_converter(Person)
+    nested = get_converter(Parent)
+
+    base = bench("from_orm(object)", lambda: Person.from_orm(obj), number)
+    fast = bench("trusted converter(object)", lambda: trusted(obj), number)
+    print(f"{'':<40} {base / fast:>11.1f}x")
+
+    fast = bench("trusted row converter(tuple)", lambda: row_trusted(row), number)
+    print(f"{'':<40} {base / fast:>11.1f}x")
+
+    base = bench(
+        "from_orm(nested 10 children)", lambda: Parent.from_orm(parent), number // 10
+    )
+    fast = bench(
+        "trusted converter(nested 10 children)", lambda: nested(parent), number // 10
+    )
+    print(f"{'':<40} {base / fast:>11.1f}x")
+
+
+if __name__ == "__main__":
+    main()
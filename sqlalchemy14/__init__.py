@@ -1,3 +1,14 @@
-from .builder import Crud
-from .engine import create_engine
+from .builder import Crud, prepare_all
+from .cache import MemoryBackend, ResultCache, SharedBackend
+from .engine import (
+    DriverConfig,
+    PoolConfig,
+    create_engine,
+    create_routing_engine,
+    create_sync_engine,
+    get_pool_metrics,
+)
+from .instrument import HistogramSink, SpanSink, add_sink, remove_sink
+from .slow_query import SlowQueryRecorder
 from .sql import Sql
+from .writer import BatchWriter
@@ -1,10 +1,27 @@
 from dataclasses import is_dataclass
-from functools import lru_cache
-from inspect import isclass
-from typing import List, Type, Union, get_args
+from inspect import isclass, signature
+from typing import Dict, FrozenSet, List, Tuple, Type, Union, get_args
 
 from pydantic import BaseModel
-from sqlalchemy import bindparam, delete, func, insert, update
+from sqlalchemy import (
+    ARRAY,
+    JSON,
+    Index,
+    LargeBinary,
+    PrimaryKeyConstraint,
+    Text,
+    UniqueConstraint,
+    bindparam,
+    cast,
+    column,
+    delete,
+    func,
+    insert,
+    table,
+    text,
+    update,
+)
+from sqlalchemy.dialects import postgresql, sqlite
 from sqlalchemy.future import select
 
 # from sqlalchemy.dialects.postgresql import insert
@@ -14,16 +31,24 @@ from sqlalchemy.orm import (
     CompositeProperty,
     RelationshipProperty,
     SynonymProperty,
+    defer,
     joinedload,
+    load_only,
+    selectinload,
 )
 
+from .registry import cached
+
 
-@lru_cache
+@cached()
 def analyze(cls):
     entity = get_entity(cls)
     primary_keys = get_primary_keys(entity)
     columns = get_columns(cls)
     table_columns, load_strategies = get_returning(entity, columns)
+    deferred = get_deferred(cls)
+    if deferred:
+        table_columns = [x for x in table_columns if x.key not in deferred]
     return entity, table_columns, primary_keys, load_strategies
 
 
@@ -84,6 +109,50 @@ def get_returning(entity, columns: Union[List[str], None]):
         return table_columns, relations
 
 
+# 自動で遅延させる大きな値を持つ型。TEXT・BYTEA・JSONBなどの派生した型を含む
+LOB_TYPES = (Text, LargeBinary, JSON)
+
+
+@cached()
+def get_deferred(cls) -> Tuple[str, ...]:
+    """ORMモデルをスキーマとする場合に、既定の取得やreturningから除くカラム名を返す。
+
+    ORMモデルの`__deferred__`にカラム名のリストを指定するか、"auto"を指定するとLOB_TYPESのカラムを除く。
+    マッパーでdeferredを指定したカラムも除く。プライマリキーは除かない
+    """
+    if get_columns(cls) is not None:
+        return ()
+
+    policy = getattr(cls, "__deferred__", ())
+    attrs = inspect(cls).column_attrs
+    if policy != "auto":
+        unknown = set(policy) - {x.key for x in attrs}
+        if unknown:
+            raise ValueError(f"Unknown deferred columns: {sorted(unknown)}")
+
+    pks = {x.key for x in get_primary_keys(cls)}
+    deferred = []
+    for x in attrs:
+        if x.key in pks:
+            continue
+        elif policy == "auto":
+            is_deferred = isinstance(x.columns[0].type, LOB_TYPES)
+        else:
+            is_deferred = x.key in policy
+        if is_deferred or x.deferred:
+            deferred.append(x.key)
+
+    return tuple(deferred)
+
+
+@cached()
+def get_select_deferred(cls, names: Tuple[str, ...]):
+    """遅延したカラムをプライマリキーとともに取得するselect"""
+    entity, returning, primary_keys, load_strategies = analyze(cls)
+    stmt = select(*primary_keys, *(getattr(entity, x) for x in names))
+    return stmt
+
+
 execution_options = dict(
     synchronize_session=False,  # セッションを同期しない
     # synchronize_session="fetch",  # update, deleteでセッションを同期する。returningを使う場合は使用できない模様
@@ -97,73 +166,504 @@ execution_options = dict(
 # 解析で取得されるreturningはrelationshipなどの結合プロパティは含まれない
 
 
-@lru_cache
+@cached()
 def get_insert(cls):
     entity, returning, primary_keys, load_strategies = analyze(cls)
     stmt = insert(entity).returning(*returning)
     return stmt
 
 
-@lru_cache
+@cached()
+def get_bulk_insert(cls):
+    """executemanyで実行するinsert。executemanyではreturningを利用できない"""
+    entity, returning, primary_keys, load_strategies = analyze(cls)
+    stmt = insert(entity)
+    return stmt
+
+
+@cached()
+def get_insert_keys(cls):
+    """プライマリキーのみを返すinsert。リレーションはこのキーで改めて取得する"""
+    entity, returning, primary_keys, load_strategies = analyze(cls)
+    stmt = insert(entity).returning(*primary_keys)
+    return stmt
+
+
+@cached()
 def get_update(cls):
     entity, returning, primary_keys, load_strategies = analyze(cls)
     stmt = update(entity)
     return stmt
 
 
-@lru_cache
+@cached()
+def get_update_returning(cls):
+    entity, returning, primary_keys, load_strategies = analyze(cls)
+    stmt = get_update(cls).returning(*returning)
+    return stmt.execution_options(**execution_options)
+
+
+@cached()
+def get_update_keys(cls):
+    """プライマリキーのみを返すupdate。リレーションはこのキーで改めて取得する"""
+    entity, returning, primary_keys, load_strategies = analyze(cls)
+    stmt = get_update(cls).returning(*primary_keys)
+    return stmt.execution_options(**execution_options)
+
+
+@cached()
 def get_select(cls):
     entity, returning, primary_keys, load_strategies = analyze(cls)
     stmt = select(entity)
     return stmt
 
 
-@lru_cache
+@cached()
+def is_projection(cls) -> bool:
+    """ORMを経由せずカラムのみを取得して変換できるスキーマか判定する"""
+    entity, returning, primary_keys, load_strategies = analyze(cls)
+
+    # 継承したモデルはテーブルのカラムだけでは取得できないのでORMに任せる
+    if inspect(entity).inherits is not None:
+        return False
+
+    return get_columns(cls) is not None and not load_strategies
+
+
+@cached()
+def get_table_columns(cls):
+    """スキーマが必要とするテーブルのカラムを返す。キーで行を特定できるようプライマリキーを補う"""
+    entity, returning, primary_keys, load_strategies = analyze(cls)
+    attrs = list(returning)
+    attrs += [x for x in primary_keys if x.key not in {y.key for y in returning}]
+    columns = []
+
+    for attr in attrs:
+        column = attr.property.columns[0]
+        columns.append(column if column.key == attr.key else column.label(attr.key))
+
+    return columns
+
+
+@cached()
+def get_select_related(cls):
+    """ORMモデルを取得するselect。スキーマが必要とするカラムとリレーションのみ読み込む"""
+    stmt = get_select(cls).options(*get_load_options(cls))
+    return stmt
+
+
+@cached()
+def get_select_columns(cls):
+    """スキーマのカラムのみを取得するselect。ORMのIDマップを経由せず行を返す"""
+    stmt = select(*get_table_columns(cls))
+    return stmt
+
+
+@cached()
+def get_get_columns(cls):
+    entity, returning, primary_keys, load_strategies = analyze(cls)
+    bind_primary_keys = [
+        x.property.columns[0] == bindparam(x.key) for x in primary_keys
+    ]
+    stmt = get_select_columns(cls).where(*bind_primary_keys)
+    return stmt
+
+
+@cached()
+def get_select_keys(cls):
+    entity, returning, primary_keys, load_strategies = analyze(cls)
+    stmt = select(*primary_keys)
+    return stmt
+
+
+@cached()
+def get_exists(cls):
+    """プライマリキーを条件とするSELECT EXISTS"""
+    entity, returning, primary_keys, load_strategies = analyze(cls)
+    bind_primary_keys = [x == bindparam(x.key) for x in primary_keys]
+    stmt = get_select_keys(cls).where(*bind_primary_keys).exists().select()
+    return stmt
+
+
+@cached()
+def get_count(cls):
+    entity, returning, primary_keys, load_strategies = analyze(cls)
+    stmt = select(func.count()).select_from(entity)
+    return stmt
+
+
+@cached()
+def get_load_options(cls):
+    """スキーマが必要とするカラムとリレーションを読み込むローダーオプションを返す。
+
+    ネストしたスキーマを再帰的に辿り、コレクションはselectinload、多対一はjoinedloadで読み込み、
+    それぞれのスキーマが必要とするカラムのみをload_onlyで取得する
+    """
+    entity, returning, primary_keys, load_strategies = analyze(cls)
+
+    if get_columns(cls) is None:
+        # ORMモデルの場合はリレーションの取得はデフォルトに任せ、遅延したカラムのみ除く
+        return [defer(getattr(entity, x)) for x in get_deferred(cls)]
+
+    options = [load_only(*returning)] if returning else []
+    options += [get_load_option(cls, x, (cls,)) for x in load_strategies]
+    return options
+
+
+def get_load_option(cls, relation, parents: Tuple[type, ...]):
+    if relation.property.uselist:
+        option = selectinload(relation)
+    else:
+        option = joinedload(relation, innerjoin=relation.property.innerjoin)
+
+    nested = get_nested_schema(cls, relation.key)
+    if nested is None or nested in parents:
+        return option
+
+    entity, returning, primary_keys, load_strategies = analyze(nested)
+    if returning:
+        option = option.load_only(*returning)
+
+    if load_strategies:
+        parents = parents + (nested,)
+        option = option.options(
+            *(get_load_option(nested, x, parents) for x in load_strategies)
+        )
+
+    return option
+
+
+def get_nested_schema(cls, name: str):
+    """リレーションのフィールドに指定されたスキーマを返す。ORMモデルやスキーマ以外の場合はNone"""
+    if issubclass(cls, BaseModel):
+        annotation = cls.__fields__[name].type_
+    elif is_dataclass(cls):
+        annotation = cls.__dataclass_fields__[name].type
+    else:
+        return None
+
+    while not isclass(annotation) and get_args(annotation):
+        annotation = [x for x in get_args(annotation) if x is not type(None)][0]
+
+    if not isclass(annotation) or getattr(annotation, "__entity__", None) is None:
+        return None
+    elif get_columns(annotation) is None:
+        return None
+    else:
+        return annotation
+
+
+@cached()
 def get_get(cls):
     entity, returning, primary_keys, load_strategies = analyze(cls)
     bind_primary_keys = []
-    options = None
 
     for pk in primary_keys:
         bind_primary_keys.append(pk == bindparam(pk.key))
 
-    for strategy in load_strategies:
-        if options is None:
-            options = joinedload(strategy, innerjoin=strategy.property.innerjoin)
-        else:
-            options.joinedload(strategy, innerjoin=strategy.property.innerjoin)
-
-    # TODO: ネストしたリレーションシップに対応するには次のようなことをしなければいけない
-    # joinedload(Parent.children).subqueryload(Child.elements)
     stmt = select(entity).where(*bind_primary_keys)
+    options = get_load_options(cls)
     if options:
-        stmt = stmt.options(options)
+        stmt = stmt.options(*options)
 
     # コンパイルできるか確認
     stmt.compile()
     return stmt
 
 
-@lru_cache
+@cached()
 def get_delete(cls):
     entity, returning, primary_keys, load_strategies = analyze(cls)
     stmt = delete(entity)
     return stmt
 
 
-@lru_cache
-def get_upsert(cls):
+@cached()
+def get_delete_keys(cls):
+    """削除したレコードのプライマリキーを返すdelete"""
+    entity, returning, primary_keys, load_strategies = analyze(cls)
+    stmt = get_delete(cls).returning(*primary_keys)
+    return stmt.execution_options(**execution_options)
+
+
+@cached()
+def get_upsert(
+    cls,
+    columns: FrozenSet[str],
+    index_elements: Tuple[str, ...] = None,
+    constraint: str = None,
+    dialect_name: str = "postgresql",
+    keys_only: bool = False,
+):
+    """挿入または更新を行うinsertを生成する。
+
+    衝突対象は`index_elements`（カラム名）か`constraint`（ユニーク制約・インデックス名）で指定し、
+    指定がなければプライマリキーで衝突を判定する。
+    衝突時は`columns`のうち衝突対象とプライマリキー以外のカラムをEXCLUDEDの値で更新する。
+    """
     entity, returning, primary_keys, load_strategies = analyze(cls)
-    on_conflict_do_update = insert(entity).returning(*returning).on_conflict_do_update
-    primary_keys = [key.name for key in inspect(entity).primary_key]
 
-    def upsert(**values):
-        # キーと更新キーを分ける必要あり
-        return on_conflict_do_update(index_elements=primary_keys, set_=values).values(
-            **values
-        )
+    if dialect_name == "postgresql":
+        stmt = postgresql.insert(entity)
+    elif dialect_name == "sqlite":
+        stmt = sqlite.insert(entity)
+    else:
+        raise NotImplementedError(dialect_name)
+
+    stmt = on_conflict_do_update(
+        cls, stmt, columns, index_elements, constraint, dialect_name
+    )
+
+    if dialect_name == "postgresql":
+        if keys_only:
+            stmt = stmt.returning(*primary_keys)
+        else:
+            stmt = stmt.returning(*returning)
+
+    return stmt
+
+
+def on_conflict_do_update(
+    cls, stmt, columns, index_elements, constraint, dialect_name: str
+):
+    """衝突対象とプライマリキー以外の`columns`をEXCLUDEDの値で更新するON CONFLICT句を付与する"""
+    entity, returning, primary_keys, load_strategies = analyze(cls)
+    index_elements = get_conflict_target(cls, index_elements, constraint)
+
+    if constraint is None:
+        conflict = dict(index_elements=index_elements)
+    elif dialect_name == "postgresql" and not isinstance(
+        get_unique_constraint(inspect(entity).local_table, constraint), Index
+    ):
+        conflict = dict(constraint=constraint)
+    else:
+        # インデックスやsqliteでは制約名を指定できないのでカラムで指定する
+        conflict = dict(index_elements=index_elements)
+
+    excludes = set(index_elements) | {x.name for x in primary_keys}
+    set_ = {k: stmt.excluded[k] for k in sorted(columns) if k not in excludes}
+    if not set_:
+        # DO NOTHINGでは衝突した行がreturningで返らないので、衝突対象を同じ値で更新する
+        set_ = {k: stmt.excluded[k] for k in index_elements}
+
+    return stmt.on_conflict_do_update(**conflict, set_=set_)
+
+
+@cached()
+def get_conflict_target(
+    cls, index_elements: Tuple[str, ...] = None, constraint: str = None
+) -> Tuple[str, ...]:
+    """upsertで衝突を判定するカラム名を返す"""
+    entity, returning, primary_keys, load_strategies = analyze(cls)
+
+    if constraint is not None:
+        target = get_unique_constraint(inspect(entity).local_table, constraint)
+        return tuple(x.name for x in target.columns)
+    elif index_elements is not None:
+        table = inspect(entity).local_table
+        for name in index_elements:
+            if name not in table.c:
+                raise KeyError(name)
+        return index_elements
+    else:
+        return tuple(x.name for x in primary_keys)
+
+
+def get_unique_constraint(table, name: str):
+    for x in table.constraints:
+        if x.name == name and isinstance(x, (UniqueConstraint, PrimaryKeyConstraint)):
+            return x
+
+    for x in table.indexes:
+        if x.name == name and x.unique:
+            return x
+
+    raise KeyError(name)
+
 
-    return upsert
+@cached()
+def get_copy_columns(cls, keys: Tuple[str, ...] = None):
+    """COPYで書き込む(値のキー, カラム)を返す。指定がなければ自動採番のプライマリキーを除く"""
+    entity, returning, primary_keys, load_strategies = analyze(cls)
+    mapper = inspect(entity)
+
+    # 継承したモデルは複数のテーブルにまたがるのでCOPYできない
+    if mapper.inherits is not None:
+        raise NotImplementedError(cls)
+
+    if keys is None:
+        # 遅延したカラムも書き込む
+        attrs, relations = get_returning(entity, get_columns(cls))
+        autoincrement = mapper.local_table._autoincrement_column
+        attrs = [x for x in attrs if x.property.columns[0] is not autoincrement]
+    else:
+        attrs = [getattr(entity, x) for x in keys]
+
+    return [(x.key, x.property.columns[0]) for x in attrs]
+
+
+@cached()
+def get_copy_staging(cls, keys: Tuple[str, ...] = None):
+    """COPYの読み込み先の一時テーブル名と、作成・削除するステートメントを返す"""
+    columns = [x for key, x in get_copy_columns(cls, keys)]
+    name = "_copy_" + columns[0].table.name
+    quoted = postgresql.dialect().identifier_preparer.quote(name)
+    query = select(*columns).compile(dialect=postgresql.dialect())
+    create = text(f"CREATE TEMP TABLE {quoted} ON COMMIT DROP AS {query} WITH NO DATA")
+    drop = text(f"DROP TABLE {quoted}")
+    return name, create, drop
+
+
+@cached()
+def get_copy_upsert(
+    cls,
+    keys: Tuple[str, ...] = None,
+    index_elements: Tuple[str, ...] = None,
+    constraint: str = None,
+):
+    """一時テーブルの行を挿入または更新するINSERT ... SELECT ... ON CONFLICTを生成する"""
+    entity, returning, primary_keys, load_strategies = analyze(cls)
+    columns = [x for key, x in get_copy_columns(cls, keys)]
+    name, create, drop = get_copy_staging(cls, keys)
+    staging = table(name, *[column(x.name) for x in columns])
+    stmt = postgresql.insert(entity).from_select(columns, select(*staging.c))
+    return on_conflict_do_update(
+        cls,
+        stmt,
+        frozenset(x.key for x in columns),
+        index_elements,
+        constraint,
+        "postgresql",
+    )
+
+
+# 値の組み合わせ毎に生成するステートメントの最大数
+STATEMENT_SHAPES_MAXSIZE = 1024
+
+# updateやdeleteの条件に使うプライマリキーのパラメータ名の接頭辞。SETの列名と衝突しないようにする
+KEY_PARAM_PREFIX = "_key_"
+
+
+def to_key_params(keys: dict) -> dict:
+    return {KEY_PARAM_PREFIX + k: v for k, v in keys.items()}
+
+
+@cached()
+def get_column_keys(cls) -> Dict[str, Union[str, None]]:
+    """属性名からカラムのキーへの対応。リレーションの属性はNoneに対応させる"""
+    entity = get_entity(cls)
+    mapper = inspect(entity)
+    keys = {x.key: None for x in mapper.relationships}
+    keys.update({x.key: x.columns[0].key for x in mapper.column_attrs})
+    return keys
+
+
+def to_column_values(cls, values: dict) -> dict:
+    """属性名の値をinsert・updateに渡すカラムのキーの値に変換し、リレーションの値は除く"""
+    keys = get_column_keys(cls)
+    return {keys.get(k, k): v for k, v in values.items() if keys.get(k, k) is not None}
+
+
+@cached(maxsize=STATEMENT_SHAPES_MAXSIZE)
+def get_values_shape(builder, cls, columns: FrozenSet[str]):
+    """insert・update・upsertのビルダーから、カラムの組み合わせ毎に固定のバインドパラメータを持つステートメントを生成する。
+
+    値をステートメントに埋め込まずに実行時に渡すことで、同じカラムの組み合わせでは常に同じSQLとなり、
+    SQLAlchemyのコンパイルキャッシュやasyncpgのプリペアドステートメントを再利用できる
+    """
+    stmt = builder(cls).values({x: bindparam(x) for x in sorted(columns)})
+    return stmt
+
+
+@cached(maxsize=STATEMENT_SHAPES_MAXSIZE)
+def get_update_shape(builder, cls, columns: FrozenSet[str]):
+    """プライマリキーを条件とするupdate。キーは`to_key_params`で変換して渡す"""
+    entity, returning, primary_keys, load_strategies = analyze(cls)
+    stmt = get_values_shape(builder, cls, columns).where(
+        *(x == bindparam(KEY_PARAM_PREFIX + x.key) for x in primary_keys)
+    )
+    return stmt
+
+
+@cached(maxsize=STATEMENT_SHAPES_MAXSIZE)
+def get_upsert_shape(
+    cls,
+    columns: FrozenSet[str],
+    index_elements: Tuple[str, ...] = None,
+    constraint: str = None,
+    dialect_name: str = "postgresql",
+    keys_only: bool = False,
+):
+    stmt = get_upsert(
+        cls,
+        columns,
+        index_elements=index_elements,
+        constraint=constraint,
+        dialect_name=dialect_name,
+        keys_only=keys_only,
+    )
+    return stmt.values({x: bindparam(x) for x in sorted(columns)})
+
+
+# UPDATE ... FROM unnest(...)のパラメータ名の接頭辞
+ARRAY_PARAM_PREFIX = "_values_"
+
+
+def is_unnestable(cls, columns: Tuple[str, ...]) -> bool:
+    """配列型のカラムは多次元配列になりunnestで展開できないので、FROM unnestの更新に使えない"""
+    entity, returning, primary_keys, load_strategies = analyze(cls)
+    table = inspect(entity).local_table
+    attrs = [*primary_keys, *(table.c[x] for x in columns)]
+    return not any(isinstance(x.type, ARRAY) for x in attrs)
+
+
+@cached(maxsize=STATEMENT_SHAPES_MAXSIZE)
+def get_update_from_arrays(cls, columns: Tuple[str, ...]):
+    """UPDATE ... FROM unnest(...)で、行毎に異なる値を１つの文で更新する（postgresqlのみ）。
+
+    カラム毎の値を配列として`ARRAY_PARAM_PREFIX + カラム名`のパラメータで渡すので、
+    行数によらず同じ文となりコンパイルキャッシュやプリペアドステートメントを再利用できる
+    """
+    entity, returning, primary_keys, load_strategies = analyze(cls)
+    table = inspect(entity).local_table
+    attrs = [*primary_keys, *(table.c[x] for x in columns)]
+    arrays = [
+        cast(bindparam(ARRAY_PARAM_PREFIX + x.key, type_=ARRAY(x.type)), ARRAY(x.type))
+        for x in attrs
+    ]
+    source = func.unnest(*arrays).table_valued(*(x.key for x in attrs))
+    source = source.render_derived(name="_values")
+    stmt = update(entity).values({x: source.c[x] for x in columns})
+    stmt = stmt.where(*(x == source.c[x.key] for x in primary_keys))
+    return stmt.returning(*primary_keys).execution_options(**execution_options)
+
+
+@cached()
+def get_delete_by_keys(cls):
+    """プライマリキーを条件とするdelete。キーは`to_key_params`で変換して渡す"""
+    entity, returning, primary_keys, load_strategies = analyze(cls)
+    stmt = get_delete_keys(cls).where(
+        *(x == bindparam(KEY_PARAM_PREFIX + x.key) for x in primary_keys)
+    )
+    return stmt
+
+
+@cached()
+def get_query(cls, name: str):
+    """スキーマの`__queries__`に定義された名前付きクエリと、そのパラメータ名を返す。
+
+    クエリは`lambda stmt, name: stmt.where(Entity.name == name)`のように、
+    スキーマを取得するselectとパラメータを受け取り、selectを返す関数で定義する。
+    パラメータには同名のbindparamを渡して１度だけ生成するので、実行時にステートメントを構築しない
+    """
+    builder = cls.__queries__[name]
+    _, *names = signature(builder).parameters
+    if is_projection(cls):
+        stmt = get_select_columns(cls)
+    else:
+        stmt = get_select_related(cls)
+    stmt = builder(stmt, **{x: bindparam(x) for x in names})
+    return stmt, tuple(names)
 
 
 def get_columns_for_pydantic(cls: Type[BaseModel]) -> List[str]:
@@ -1,12 +1,85 @@
-from functools import lru_cache
+from dataclasses import asdict, is_dataclass
 from inspect import _empty as Undefined
-from typing import TYPE_CHECKING, Any, Generic, List, Literal, Type, TypeVar, get_args
+from typing import (
+    TYPE_CHECKING,
+    Any,
+    AsyncIterable,
+    Generic,
+    Iterable,
+    List,
+    Literal,
+    Optional,
+    Tuple,
+    Type,
+    TypeVar,
+    Union,
+    get_args,
+)
 
 from pydantic import BaseModel
+from sqlalchemy import ARRAY, and_, any_, bindparam, func, or_, tuple_
 from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.future import select
+from sqlalchemy.orm import Session, configure_mappers, make_transient_to_detached
+from sqlalchemy.orm.attributes import set_committed_value
+from sqlalchemy.sql import compiler, operators
+from sqlalchemy.sql.dml import Delete, Update
+from sqlalchemy.sql.elements import UnaryExpression
 
-from .analyzer import analyze, get_columns, get_entity
+from .analyzer import (
+    ARRAY_PARAM_PREFIX,
+    analyze,
+    execution_options,
+    get_bulk_insert,
+    get_column_keys,
+    get_columns,
+    get_conflict_target,
+    get_copy_columns,
+    get_copy_staging,
+    get_copy_upsert,
+    get_count,
+    get_deferred,
+    get_delete,
+    get_delete_by_keys,
+    get_delete_keys,
+    get_entity,
+    get_exists,
+    get_get,
+    get_get_columns,
+    get_insert,
+    get_insert_keys,
+    get_query,
+    get_select_columns,
+    get_select_deferred,
+    get_select_keys,
+    get_select_related,
+    get_update,
+    get_update_from_arrays,
+    get_update_keys,
+    get_update_returning,
+    get_update_shape,
+    get_upsert,
+    get_upsert_shape,
+    get_values_shape,
+    is_projection,
+    is_unnestable,
+    to_column_values,
+    to_key_params,
+)
+from .cache import (
+    ResultCache,
+    is_written,
+    mark_written,
+    register_cache,
+)
+from .converter import get_converter, get_row_converter, is_trusted
+from .cursor import decode_cursor, encode_cursor
+from .explain import Explain, get_plan
+from .instrument import instrumented, instrumented_stream, measure_db
+from .loader import KeyLoader
+from .registry import cached, register, schemas
 from .sql import Sql
+from .sync import SessionAdapter, run
 
 T = TypeVar("T")
 S = TypeVar("S")
@@ -47,6 +120,21 @@ def split_keys_values(cls: "DynamimcAsyncCrud", kwargs):
     return keys, kwargs
 
 
+def to_keys(cls: "DynamimcAsyncCrud", key) -> dict:
+    """値・タプル・辞書で指定されたキーをプライマリキーの辞書に変換する"""
+    names = [x.name for x in cls.get_primary_keys()]
+    if isinstance(key, dict):
+        return {x: key[x] for x in names}
+    elif isinstance(key, (tuple, list)):
+        if len(key) != len(names):
+            raise ValueError(key)
+        return dict(zip(names, key))
+    elif len(names) == 1:
+        return {names[0]: key}
+    else:
+        raise ValueError(key)
+
+
 def split_where_values(cls: "DynamimcAsyncCrud", kwargs):
     conditions = [x == kwargs[x.name] for x in cls.get_primary_keys()]
     for key in cls.get_primary_keys():
@@ -54,8 +142,200 @@ def split_where_values(cls: "DynamimcAsyncCrud", kwargs):
     return conditions, kwargs
 
 
+# postgresqlでは１つのステートメントに32767個までしかパラメータをバインドできない
+MAX_BIND_PARAMS = 32767
+
+
+def to_values(obj) -> dict:
+    if isinstance(obj, BaseModel):
+        return obj.dict()
+    elif is_dataclass(obj):
+        return asdict(obj)
+    else:
+        return dict(obj)
+
+
+def iter_chunks(rows: Iterable[dict], chunk_size: int, max_params: int):
+    """カラム構成が同じ行をまとめ、行数とバインドパラメータ数の上限を超えないように分割する"""
+    chunk: List[dict] = []
+    columns = None
+    size = chunk_size
+
+    for row in rows:
+        if chunk and (row.keys() != columns or len(chunk) >= size):
+            yield chunk
+            chunk = []
+
+        if not chunk:
+            columns = row.keys()
+            size = max(1, min(chunk_size, max_params // max(len(columns), 1)))
+
+        chunk.append(row)
+
+    if chunk:
+        yield chunk
+
+
+async def aiter_chunks(rows: Union[Iterable, AsyncIterable], chunk_size: int):
+    """同期・非同期のイテラブルから、chunk_size件ずつのリストを返す"""
+    chunk: list = []
+
+    if not hasattr(rows, "__aiter__"):
+        rows = to_async_iterable(rows)
+
+    async for row in rows:
+        chunk.append(row)
+        if len(chunk) >= chunk_size:
+            yield chunk
+            chunk = []
+
+    if chunk:
+        yield chunk
+
+
+async def to_async_iterable(rows: Iterable):
+    for row in rows:
+        yield row
+
+
+def to_record(keys: List[str], obj) -> tuple:
+    """行をCOPYで書き込むカラム順のタプルに変換する。タプルはカラム順に並んでいるものとみなす"""
+    if isinstance(obj, tuple):
+        return obj
+    values = to_values(obj)
+    return tuple(values[x] for x in keys)
+
+
+def is_returning_supported(db) -> bool:
+    """接続先のDBでreturningが利用できるか判定する"""
+    bind = db.bind
+    return bind is not None and bind.dialect.full_returning
+
+
+def get_seek_order(cls: "DynamimcAsyncCrud", order_by) -> List[Tuple[Any, bool]]:
+    """並び順を(カラム, 降順か)のリストに正規化する。順序を一意にするためプライマリキーを補う"""
+    orders = []
+    for x in order_by or []:
+        if isinstance(x, str):
+            desc = x.startswith("-")
+            orders.append((getattr(cls.__entity__, x.lstrip("-")), desc))
+        elif isinstance(x, UnaryExpression):
+            desc = x.modifier is operators.desc_op
+            orders.append((x.element, desc))
+        else:
+            orders.append((x, False))
+
+    names = {getattr(x, "key", None) for x, desc in orders}
+    for pk in cls.get_primary_keys():
+        if pk.key not in names:
+            orders.append((pk, orders[-1][1] if orders else False))
+
+    return orders
+
+
+def get_seek_condition(orders: List[Tuple[Any, bool]], values: list):
+    """キーセットページネーションで、指定した位置より後ろの行を取得する条件を返す"""
+    if len(orders) != len(values):
+        raise ValueError("cursor does not match order_by")
+
+    if len({desc for x, desc in orders}) == 1:
+        columns = [x for x, desc in orders]
+        if orders[0][1]:
+            return tuple_(*columns) < tuple_(*values)
+        else:
+            return tuple_(*columns) > tuple_(*values)
+
+    # 昇順と降順が混在する場合は行値の比較が使えないので展開する
+    conditions = []
+    for i, (column, desc) in enumerate(orders):
+        equals = [x == v for (x, d), v in zip(orders[:i], values[:i])]
+        compare = column < values[i] if desc else column > values[i]
+        conditions.append(and_(*equals, compare))
+    return or_(*conditions)
+
+
+def get_dialect_name(db) -> str:
+    bind = db.bind
+    return "postgresql" if bind is None else bind.dialect.name
+
+
+def iter_statements(schema, dialect=None):
+    """スキーマのcrudが実行するステートメントと、実行時に渡すパラメータ名を列挙する"""
+    crud = schema.crud
+    pks = [x.key for x in crud.get_primary_keys()]
+    has_relations = bool(crud.get_load_strategies())
+
+    if is_projection(schema):
+        yield get_select_columns(schema), []
+        yield get_get_columns(schema), sorted(pks)
+    else:
+        yield get_select_related(schema), []
+        yield get_get(schema), sorted(pks)
+
+    for name in getattr(schema, "__queries__", {}):
+        stmt, names = get_query(schema, name)
+        yield stmt, sorted(names)
+
+    if dialect is not None and not dialect.full_returning:
+        return
+
+    column_keys = get_column_keys(schema)
+    columns = frozenset(column_keys[x.key] for x in crud.get_returnings()) - set(pks)
+    insert = get_insert_keys if has_relations else get_insert
+    update = get_update_keys if has_relations else get_update_returning
+    key_params = list(to_key_params(dict.fromkeys(pks)))
+
+    yield get_values_shape(insert, schema, columns), sorted(columns)
+    yield get_update_shape(update, schema, columns), sorted([*columns, *key_params])
+    yield get_delete_by_keys(schema), sorted(key_params)
+
+
+def to_orm_statement(stmt):
+    """ORMで実行する文を、実行時にコンパイル済みキャッシュのキーとなる形にする。
+
+    ORMのupdate・deleteは実行時にセッションの同期方法で注釈されるので、同じ注釈を付与する
+    """
+    if not isinstance(stmt, (Update, Delete)):
+        return stmt
+    if stmt._propagate_attrs.get("compile_state_plugin") != "orm":
+        return stmt
+
+    sync = stmt._execution_options.get("synchronize_session", "evaluate")
+    return stmt._annotate({"synchronize_session": sync})
+
+
+def prepare_all(engine=None):
+    """登録された全てのスキーマを解析し、ステートメントと変換関数を事前に生成します。
+
+    マッパーの構成・解析・コンパイルを起動時に済ませ、デプロイ直後のリクエストの遅延を防ぎます。
+    エンジンを指定した場合は、エンジンのコンパイル済みキャッシュにも格納します。
+    """
+    configure_mappers()
+
+    engine = getattr(engine, "sync_engine", engine)
+    dialect = None if engine is None else engine.dialect
+
+    for schema in list(schemas):
+        if schema.crud.__entity__ is not schema:
+            trusted = is_trusted(schema)
+            get_converter(schema, trusted)
+            get_row_converter(schema, trusted)
+
+        for stmt, keys in iter_statements(schema, dialect):
+            if engine is None:
+                stmt.compile()
+            else:
+                to_orm_statement(stmt)._compile_w_cache(
+                    dialect,
+                    compiled_cache=engine._compiled_cache,
+                    column_keys=keys,
+                    linting=dialect.compiler_linting | compiler.WARN_LINTING,
+                )
+
+
 class Crud(Generic[T]):
     __entity__: Type[T]  # declarative_base
+    __trusted__ = False  # Trueの場合はDBから取得した値を検証せずにスキーマへ変換する
     sql: Sql
 
     if TYPE_CHECKING:
@@ -64,6 +344,10 @@ class Crud(Generic[T]):
         def crud(cls: Type[OWN], db) -> "DynamimcAsyncCrud[OWN]":
             ...
 
+        @classmethod
+        def crud_sync(cls: Type[OWN], db) -> "DynamicSyncCrud[OWN]":
+            ...
+
     def __init_subclass__(cls, *args, **kwargs):
         own_or_generic = get_own_or_generics(cls, Crud)
 
@@ -76,10 +360,13 @@ class Crud(Generic[T]):
         cls.__entity__ = own_or_generic
         cls.sql = Sql(cls)
         cls.crud = DynamimcAsyncCrud._create_class(cls)  # type: ignore
+        cls.crud_sync = DynamicSyncCrud._create_class(cls)  # type: ignore
+        register(cls)
 
 
 class DynamimcAsyncCrud(Generic[T]):
     sql: Sql
+    cache: Optional[ResultCache]
     __schema__: Type[T]
     __entity__ = None
 
@@ -99,47 +386,97 @@ class DynamimcAsyncCrud(Generic[T]):
         cls.__schema__ = own_or_generic
         cls.__entity__ = get_entity(own_or_generic)
         cls.sql = Sql(cls.__schema__)
+        cls.cache = getattr(cls.__schema__, "__cache__", None)
         schema = cls.__schema__
 
+        if cls.cache is not None:
+            register_cache(schema)
+
         if cls.__entity__ is cls.__schema__:
-            pass
+            entity = cls.__entity__
+
+            def output_row(row):
+                # 行の列名はカラム名なので、returningの順に位置で属性に対応させる
+                returning = cls.get_returnings()
+                obj = entity(**{x.key: row[i] for i, x in enumerate(returning)})
+                # insertで生成したオブジェクトはセッション外で永続化済みとして扱う
+                make_transient_to_detached(obj)
+                return obj
+
+            cls.output_row = staticmethod(output_row)  # type: ignore
         else:
             schema = cls.__schema__
-            columns: List[str] = get_columns(schema)  # type: ignore
+            trusted = is_trusted(schema)
 
+            # 変換関数はマッパーの初期化後、初回の変換時に生成されキャッシュされる
             def output(row):
-                return schema.from_orm(row)
+                return get_converter(schema, trusted)(row)
+
+            def output_row(row):
+                return get_row_converter(schema, trusted)(row)
 
             cls.output = staticmethod(output)  # type: ignore
+            cls.output_row = staticmethod(output_row)  # type: ignore
 
     @classmethod
-    @lru_cache
+    @cached()
     def get_primary_keys(cls):
         # __init_subclass__で実行すると、sqlalchemyが初期化されていないのでカラムを取得できない
         entity, returning, primary_keys, load_strategies = analyze(cls.__schema__)
         return primary_keys
 
     @classmethod
-    @lru_cache
+    @cached()
     def get_returnings(cls):
         # __init_subclass__で実行すると、sqlalchemyが初期化されていないのでカラムを取得できない
         entity, returning, primary_keys, load_strategies = analyze(cls.__schema__)
         return returning
 
     @classmethod
-    @lru_cache
+    @cached()
     def get_load_strategies(cls):
         # __init_subclass__で実行すると、sqlalchemyが初期化されていないのでカラムを取得できない
         entity, returning, primary_keys, load_strategies = analyze(cls.__schema__)
         return load_strategies
 
-    def __init__(self, db: AsyncSession):
+    def __init__(self, db: AsyncSession, *, batch: bool = False):
+        """batch=Trueの場合、同じtick内で呼ばれたgetをまとめて１つのクエリで取得します"""
         self.db: AsyncSession = db
+        self.batch = batch
 
     @staticmethod
     def output(row):
         return row
 
+    def _select(self):
+        """スキーマがカラムのみで構成される場合は、ORMを経由せずカラムのみ取得する"""
+        if is_projection(self.__schema__):
+            return get_select_columns(self.__schema__)
+        else:
+            return get_select_related(self.__schema__)
+
+    def _output(self):
+        """_selectで取得した行をスキーマに変換する関数を返す"""
+        if is_projection(self.__schema__):
+            return self.output_row
+        else:
+            return self.output
+
+    def _rows(self, cur):
+        if is_projection(self.__schema__):
+            return cur
+        else:
+            return cur.scalars()
+
+    async def _execute(self, stmt, params=None):
+        return await measure_db(self.db.execute(stmt, params))
+
+    @staticmethod
+    def output_row(row):
+        """returningなどで取得したRowを出力に変換する"""
+        return row
+
+    @instrumented
     async def get_or_none(self, *args, **kwargs):
         if args and kwargs:
             raise Exception()
@@ -156,8 +493,33 @@ class DynamimcAsyncCrud(Generic[T]):
         else:
             condition = kwargs
 
+        if self.cache is None or is_written(self.db.sync_session):
+            return await self._get_or_none(condition)
+
+        keys = to_keys(self.__class__, condition)
+        result = await self.cache.get(self.__schema__, keys)
+        if result is None:
+            result = await self._get_or_none(condition)
+            if result is not None:
+                await self.cache.set(self.__schema__, keys, result)
+        return result
+
+    def _invalidate(self, keys: List[dict] = None):
+        """書き込んだ行を記録し、コミットした後にキャッシュを破棄する。キーを指定しない場合は全て破棄する"""
+        mark_written(self.db.sync_session, self.__entity__, keys)
+
+    async def _get_or_none(self, condition: dict):
+        if self.batch:
+            return await KeyLoader.get(self).load(to_keys(self.__class__, condition))
+
+        if is_projection(self.__schema__):
+            stmt = get_get_columns(self.__schema__)
+            cur = await self._execute(stmt, condition)
+            row = cur.one_or_none()
+            return None if row is None else self.output_row(row)
+
         stmt = self.sql.get()
-        cur = await self.db.execute(stmt.params(**condition))
+        cur = await self._execute(stmt, condition)
         result = cur.unique().scalar_one_or_none()
         if result is None:
             return None
@@ -168,45 +530,431 @@ class DynamimcAsyncCrud(Generic[T]):
             self.db.expunge(result)
             return self.output(result)
 
+    @instrumented
+    async def undefer(self, obj, /, *names: str):
+        """既定の取得から除いたカラムを取得してオブジェクトに設定し、オブジェクトを返します。
+
+        カラム名を指定しない場合は、遅延した全てのカラムを取得します。ORMモデルのスキーマでのみ利用できます。
+        """
+        result = await self.undefer_many([obj], *names)
+        return result[0]
+
+    @instrumented
+    async def undefer_many(self, objects: Iterable[Any], /, *names: str) -> list:
+        """複数のオブジェクトの遅延したカラムを１つのクエリで取得して設定し、オブジェクトのリストを返します"""
+        if self.__entity__ is not self.__schema__:
+            raise NotImplementedError(self.__schema__)
+
+        objects = list(objects)
+        names = names or get_deferred(self.__schema__)
+        if not objects or not names:
+            return objects
+
+        pks = self.get_primary_keys()
+        keys = [tuple(getattr(x, pk.key) for pk in pks) for x in objects]
+        stmt = get_select_deferred(self.__schema__, tuple(names))
+        cur = await self._execute(stmt.where(self._keys_condition(pks, keys)))
+        rows = {tuple(x[: len(pks)]): x[len(pks) :] for x in cur}
+
+        for obj, key in zip(objects, keys):
+            if key not in rows:
+                raise KeyError(key)
+            # 変更として扱われないよう、読み込んだ値として設定する
+            for name, value in zip(names, rows[key]):
+                set_committed_value(obj, name, value)
+
+        return objects
+
+    @instrumented
+    async def get_many_or_none(self, ids: Iterable[Any]) -> list:
+        """キーのリストに対応するオブジェクトを１つのクエリで取得し、キーの順に返します。
+
+        キーには値（単一のプライマリキー）・タプル・辞書を指定でき、存在しないキーはNoneになります。
+        """
+        keys = [to_keys(self.__class__, x) for x in ids]
+        return await self._get_by_keys(keys)
+
+    @instrumented
+    async def get_many(self, ids: Iterable[Any]) -> list:
+        """キーのリストに対応するオブジェクトを返します。存在しないキーがあればKeyErrorを送出します"""
+        ids = list(ids)
+        result = await self.get_many_or_none(ids)
+        missing = [key for key, obj in zip(ids, result) if obj is None]
+        if missing:
+            raise KeyError(missing)
+        return result
+
+    @instrumented
     async def get(self, *args, **kwargs):
         result = await self.get_or_none(*args, **kwargs)
         if result is None:
             raise KeyError()
         return result
 
+    @instrumented
     async def exist(self, *args, **kwargs) -> bool:
-        result = await self.get_or_none(*args, **kwargs)
-        return True if result else False
+        if args and kwargs:
+            raise Exception()
+
+        if args:
+            pks = self.get_primary_keys()
+            if len(args) != 1:
+                raise Exception()
+
+            if len(pks) != 1:
+                raise Exception()
+
+            kwargs = {pks[0].key: args[0]}
+
+        return await self.exists(**kwargs)
+
+    @instrumented
+    async def exists(self, *criterion, **kwargs) -> bool:
+        """オブジェクトを読み込まずに、SELECT EXISTSで条件を満たす行が存在するか確認します。
+
+        キーワード引数はカラムとの等価条件になります。
+        """
+        keys = {x.key for x in self.get_primary_keys()}
+        if not criterion and kwargs.keys() == keys:
+            cur = await self._execute(get_exists(self.__schema__), kwargs)
+            return cur.scalar_one()
 
+        conditions = (getattr(self.__entity__, k) == v for k, v in kwargs.items())
+        stmt = get_select_keys(self.__schema__).where(*criterion, *conditions)
+        cur = await self._execute(stmt.exists().select())
+        return cur.scalar_one()
+
+    @instrumented
+    async def count(
+        self, *criterion, estimate: bool = False, query_builder=None
+    ) -> int:
+        """条件を満たす行数を返します。
+
+        estimate=Trueの場合、PostgreSQLでは行を数えずにプランナの推定行数（EXPLAIN）を返します。
+        統計情報に基づくため正確ではありません。その他のDBでは常に正確な行数を返します。
+        """
+        stmt = get_select_keys(self.__schema__).where(*criterion)
+        if query_builder is not None:
+            stmt = query_builder(stmt).order_by(None)
+
+        if estimate and get_dialect_name(self.db) == "postgresql":
+            cur = await self._execute(Explain(stmt))
+            return get_plan(cur.scalar_one())["Plan Rows"]
+
+        if query_builder is None:
+            stmt = get_count(self.__schema__).where(*criterion)
+        else:
+            stmt = select(func.count()).select_from(stmt.subquery())
+        cur = await self._execute(stmt)
+        return cur.scalar_one()
+
+    @instrumented
     async def create(self, obj: BaseModel = None, /, **kwargs):
         if obj:
             assert not kwargs
             kwargs = obj.dict()
 
         keys, values = split_keys_values(self.__class__, kwargs)
+        mark_written(self.db.sync_session)
+
+        if not is_returning_supported(self.db):
+            return await self._create_by_flush(values)
+
+        values = to_column_values(self.__schema__, values)
+        if self.get_load_strategies():
+            # リレーションはreturningで取得できないので、キーを元に改めて取得する
+            stmt = get_values_shape(get_insert_keys, self.__schema__, frozenset(values))
+            cur = await self._execute(stmt, values)
+            keys = dict(cur.one()._mapping)
+            return await self.get(**keys)
+
+        stmt = get_values_shape(get_insert, self.__schema__, frozenset(values))
+        cur = await self._execute(stmt, values)
+        return self.output_row(cur.one())
+
+    async def _create_by_flush(self, values: dict):
         obj = self.__entity__(**values)
         self.db.add(obj)
-        await self.db.flush()  # flushしないとリフレッシュできない
+        await measure_db(self.db.flush())  # flushしないとリフレッシュできない
         # await self.db.refresh(obj)  # リフレッシュしないと後続のselectで取れない　←　そんなことはなさそうだ？？
         self.db.expunge(obj)
         keys = extract_keys(self.__class__, obj)
         return await self.get(**keys)
 
+    @instrumented
+    async def create_many(
+        self,
+        rows: Iterable[Any],
+        /,
+        *,
+        returning: bool = True,
+        chunk_size: int = 1000,
+        max_params: int = MAX_BIND_PARAMS,
+    ):
+        """複数行を一括で挿入します。
+
+        returning=Trueの場合は挿入した行をスキーマに変換して返し、
+        Falseの場合はexecutemanyで挿入し挿入した行数を返します。
+        """
+        values = (split_keys_values(self.__class__, to_values(x))[1] for x in rows)
+        mark_written(self.db.sync_session)
+
+        if returning and not is_returning_supported(self.db):
+            return [await self._create_by_flush(x) for x in values]
+
+        values = (to_column_values(self.__schema__, x) for x in values)
+        if not returning:
+            count = 0
+            stmt = get_bulk_insert(self.__schema__)
+            for chunk in iter_chunks(values, chunk_size, max_params):
+                await self._execute(stmt, chunk)
+                count += len(chunk)
+            return count
+
+        result = []
+        for chunk in iter_chunks(values, chunk_size, max_params):
+            if self.get_load_strategies():
+                # リレーションはreturningで取得できないので、キーを元に改めて取得する
+                stmt = get_insert_keys(self.__schema__).values(chunk)
+                cur = await self._execute(stmt)
+                keys = [dict(x._mapping) for x in cur]
+                result.extend(await self._get_by_keys(keys))
+            else:
+                cur = await self._execute(self.sql.insert_many(chunk))
+                result.extend(self.output_row(x) for x in cur)
+
+        return result
+
+    async def _get_by_keys(self, keys: List[dict], columns=None):
+        """キーのリストに対応するオブジェクトを１つのクエリで取得し、キーの順に返す"""
+        pks = self.get_primary_keys() if columns is None else columns
+        if not keys:
+            return []
+
+        values = [tuple(x[pk.name] for pk in pks) for x in keys]
+        condition = self._keys_condition(pks, values)
+
+        objects = {}
+        if is_projection(self.__schema__):
+            cur = await self._execute(self._select().where(condition))
+            rows = cur
+        else:
+            cur = await self._execute(self._select().where(condition))
+            rows = cur.unique().scalars()
+
+        for obj in rows:
+            if not is_projection(self.__schema__):
+                self.db.expunge(obj)
+            objects[tuple(getattr(obj, pk.name) for pk in pks)] = obj
+
+        output = self._output()
+        return [output(objects[x]) if x in objects else None for x in values]
+
+    def _keys_condition(self, pks, values: List[tuple]):
+        """キーの値のタプルのいずれかに一致する条件を返す"""
+        if len(pks) != 1:
+            return tuple_(*pks).in_(values)
+        elif get_dialect_name(self.db) == "postgresql":
+            # 件数によらず同じステートメントになるよう配列を１つのパラメータとして渡す
+            array = bindparam("keys", [x[0] for x in values], ARRAY(pks[0].type))
+            return pks[0] == any_(array)
+        else:
+            return pks[0].in_([x[0] for x in values])
+
+    @instrumented
+    async def upsert(
+        self,
+        obj: BaseModel = None,
+        /,
+        *,
+        index_elements: List[str] = None,
+        constraint: str = None,
+        **kwargs,
+    ):
+        """挿入または更新を行います。衝突対象を指定しない場合はプライマリキーで衝突を判定します。"""
+        if obj:
+            assert not kwargs
+            kwargs = obj.dict()
+
+        result = await self.upsert_many(
+            [kwargs], index_elements=index_elements, constraint=constraint
+        )
+        return result[0]
+
+    @instrumented
+    async def upsert_many(
+        self,
+        rows: Iterable[Any],
+        /,
+        *,
+        index_elements: List[str] = None,
+        constraint: str = None,
+        returning: bool = True,
+        chunk_size: int = 1000,
+        max_params: int = MAX_BIND_PARAMS,
+    ):
+        """複数行の挿入または更新を一括で行います。
+
+        衝突時は衝突対象とプライマリキー以外のカラムを更新します。
+        １つのチャンクに同じキーの行が複数含まれるとpostgresqlではエラーになります。
+        """
+        if index_elements is not None:
+            index_elements = tuple(index_elements)
+
+        dialect_name = get_dialect_name(self.db)
+        is_returning = is_returning_supported(self.db)
+        keys_only = bool(self.get_load_strategies())
+        target = get_conflict_target(self.__schema__, index_elements, constraint)
+        target_columns = [getattr(self.__entity__, x) for x in target]
+        pks = tuple(x.name for x in self.get_primary_keys())
+
+        count = 0
+        result = []
+        values = (to_column_values(self.__schema__, to_values(x)) for x in rows)
+        for chunk in iter_chunks(values, chunk_size, max_params):
+            options = dict(
+                index_elements=index_elements,
+                constraint=constraint,
+                dialect_name=dialect_name,
+                keys_only=keys_only,
+            )
+            if len(chunk) == 1:
+                stmt = get_upsert_shape(self.__schema__, frozenset(chunk[0]), **options)
+                cur = await self._execute(stmt, chunk[0])
+            else:
+                stmt = get_upsert(self.__schema__, frozenset(chunk[0]), **options)
+                cur = await self._execute(stmt.values(chunk))
+            count += len(chunk)
+            # 衝突対象がプライマリキーでなければ更新した行のキーが分からないので全て破棄する
+            changed = [{k: x.get(k) for k in target} for x in chunk]
+            self._invalidate(changed if target == pks else None)
+
+            if not returning:
+                continue
+            elif not is_returning:
+                # returningが利用できない場合は衝突対象のカラムで改めて取得する
+                keys = [{k: x[k] for k in target} for x in chunk]
+                result.extend(await self._get_by_keys(keys, target_columns))
+            elif keys_only:
+                # リレーションはreturningで取得できないので、キーを元に改めて取得する
+                keys = [dict(x._mapping) for x in cur]
+                result.extend(await self._get_by_keys(keys))
+            else:
+                result.extend(self.output_row(x) for x in cur)
+
+        return result if returning else count
+
+    @instrumented
+    async def copy_in(
+        self,
+        rows: Union[Iterable[Any], AsyncIterable[Any]],
+        /,
+        *,
+        columns: List[str] = None,
+        upsert: bool = False,
+        index_elements: List[str] = None,
+        constraint: str = None,
+        chunk_size: int = 10000,
+    ) -> int:
+        """COPYで複数行を一括で挿入し、行数を返します（asyncpgのみ）。
+
+        行はスキーマ・dict・カラム順のタプルを、同期・非同期のイテラブルで渡します。
+        カラムを指定しない場合は、スキーマのカラムから自動採番のプライマリキーを除いたものを書き込みます。
+        upsert=Trueまたは衝突対象を指定した場合は、一時テーブルに読み込んでからINSERT ... ON CONFLICTで挿入または更新します。
+        """
+        if columns is not None:
+            columns = tuple(columns)
+        if index_elements is not None:
+            index_elements = tuple(index_elements)
+        upsert = upsert or index_elements is not None or constraint is not None
+
+        copy_columns = get_copy_columns(self.__schema__, columns)
+        keys = [key for key, x in copy_columns]
+        names = [x.name for key, x in copy_columns]
+        conn = await self._get_copy_connection()
+        mark_written(self.db.sync_session)
+
+        if upsert:
+            name, create, drop = get_copy_staging(self.__schema__, columns)
+            await self._execute(create)
+            table, schema = name, None
+        else:
+            target = copy_columns[0][1].table
+            table, schema = target.name, target.schema
+
+        count = 0
+        async for chunk in aiter_chunks(rows, chunk_size):
+            records = [to_record(keys, x) for x in chunk]
+            await measure_db(
+                conn.copy_records_to_table(
+                    table, records=records, columns=names, schema_name=schema
+                )
+            )
+            count += len(records)
+
+        if upsert:
+            stmt = get_copy_upsert(self.__schema__, columns, index_elements, constraint)
+            cur = await self._execute(stmt)
+            count = cur.rowcount
+            await self._execute(drop)
+            self._invalidate()
+
+        return count
+
+    async def _get_copy_connection(self):
+        """セッションのトランザクションでCOPYを実行するasyncpgの接続を返す"""
+        begun = self.db.in_transaction()
+        conn = await self.db.connection()
+        dialect = conn.dialect
+        if dialect.driver != "asyncpg":
+            raise NotImplementedError(f"{dialect.name}+{dialect.driver}")
+
+        if not begun:
+            # asyncpgのアダプタはトランザクションを最初の文の実行時に開始するので、COPYが先行する場合は文を実行して開始しておく
+            await conn.exec_driver_sql("SELECT 1")
+        return conn.sync_connection.connection.driver_connection
+
+    @instrumented
     async def update_or_pass(self, obj: BaseModel = None, /, **kwargs):
         if obj:
             assert not kwargs
             kwargs = obj.dict(exclude_unset=True)
 
         keys, values = split_keys_values(self.__class__, kwargs)
+        values = to_column_values(self.__schema__, values)
         condtions = (getattr(self.__entity__, k) == v for k, v in keys.items())
 
-        if not await self.exist(**keys):
-            return None
+        if not is_returning_supported(self.db):
+            if not await self.exist(**keys):
+                return None
 
-        stmt = self.sql.update(**values).where(*condtions)
-        cur = await self.db.execute(stmt)
-        return await self.get_or_none(**keys)
+            stmt = self.sql.update(**values).where(*condtions)
+            stmt = stmt.execution_options(**execution_options)
+            cur = await self._execute(stmt)
+            self._invalidate([keys])
+            return await self.get_or_none(**keys)
 
+        if self.get_load_strategies():
+            # リレーションはreturningで取得できないので、キーを元に改めて取得する
+            stmt = get_update_shape(get_update_keys, self.__schema__, frozenset(values))
+            cur = await self._execute(stmt, {**values, **to_key_params(keys)})
+            if cur.one_or_none() is None:
+                return None
+            self._invalidate([keys])
+            return await self.get_or_none(**keys)
+
+        stmt = get_update_shape(
+            get_update_returning, self.__schema__, frozenset(values)
+        )
+        cur = await self._execute(stmt, {**values, **to_key_params(keys)})
+        row = cur.one_or_none()
+        if row is None:
+            return None
+        else:
+            self._invalidate([keys])
+            return self.output_row(row)
+
+    @instrumented
     async def update(self, obj: BaseModel = None, /, **kwargs):
         result = await self.update_or_pass(obj, **kwargs)
         if not result:
@@ -214,6 +962,66 @@ class DynamimcAsyncCrud(Generic[T]):
         else:
             return result
 
+    @instrumented
+    async def update_many(
+        self,
+        rows: Iterable[Any],
+        /,
+        *,
+        returning: bool = False,
+        chunk_size: int = 1000,
+        max_params: int = MAX_BIND_PARAMS,
+    ):
+        """プライマリキーを含む複数行を、行毎に異なる値で一括更新します。
+
+        更新した行数を返し、returning=Trueの場合は更新した行のキーを返します。
+        プライマリキー以外のカラムを含まない行はValueErrorになります。
+        postgresqlではUPDATE ... FROM unnest(...)、その他のDBや配列型のカラムを含む場合はexecutemanyで更新します。
+        """
+        pks = self.get_primary_keys()
+        names = [x.name for x in pks]
+        is_postgres = get_dialect_name(self.db) == "postgresql"
+        is_postgres = is_postgres and is_returning_supported(self.db)
+
+        count = 0
+        result = []
+        values = (to_column_values(self.__schema__, to_values(x)) for x in rows)
+        for chunk in iter_chunks(values, chunk_size, max_params):
+            keys = [{k: x[k] for k in names} for x in chunk]
+            columns = tuple(sorted(chunk[0].keys() - set(names)))
+            if not columns:
+                raise ValueError("rows have no columns to update.")
+
+            if is_postgres and is_unnestable(self.__schema__, columns):
+                stmt = get_update_from_arrays(self.__schema__, columns)
+                params = {
+                    ARRAY_PARAM_PREFIX + k: [x[k] for x in chunk]
+                    for k in (*names, *columns)
+                }
+                cur = await self._execute(stmt, params)
+                updated = [dict(x._mapping) for x in cur]
+            else:
+                # executemanyでは更新した行数を取得できないドライバがあるので、更新する前に存在するキーを取得する
+                condition = self._keys_condition(pks, [tuple(x.values()) for x in keys])
+                stmt = get_select_keys(self.__schema__).where(condition)
+                updated = [dict(x._mapping) for x in await self._execute(stmt)]
+
+                stmt = get_update_shape(get_update, self.__schema__, frozenset(columns))
+                stmt = stmt.execution_options(**execution_options)
+                params = [
+                    {**{k: x[k] for k in columns}, **to_key_params(key)}
+                    for x, key in zip(chunk, keys)
+                ]
+                await self._execute(stmt, params)
+
+            count += len(updated)
+            if returning:
+                result.extend(updated)
+            self._invalidate(keys)
+
+        return result if returning else count
+
+    @instrumented
     async def delete_or_pass(self, obj: BaseModel = None, /, **kwargs):
         if obj:
             assert not kwargs
@@ -222,13 +1030,21 @@ class DynamimcAsyncCrud(Generic[T]):
         keys, values = split_keys_values(self.__class__, kwargs)
         condtions = (getattr(self.__entity__, k) == v for k, v in keys.items())
 
-        if not await self.exist(**keys):
-            return 0
+        if not is_returning_supported(self.db):
+            if not await self.exist(**keys):
+                return 0
 
-        stmt = self.sql.delete().where(*condtions)
-        cur = await self.db.execute(stmt)
-        return 1
+            stmt = self.sql.delete().where(*condtions)
+            cur = await self._execute(stmt)
+            self._invalidate([keys])
+            return 1
+
+        stmt = get_delete_by_keys(self.__schema__)
+        cur = await self._execute(stmt, to_key_params(keys))
+        self._invalidate([keys])
+        return len(cur.all())
 
+    @instrumented
     async def delete(self, obj: BaseModel = None, /, **kwargs):
         count = await self.delete_or_pass(obj, **kwargs)
         if not count:
@@ -236,44 +1052,295 @@ class DynamimcAsyncCrud(Generic[T]):
         else:
             return 1
 
+    @instrumented
+    async def delete_many(
+        self, ids: Iterable[Any], /, *, returning: bool = False, chunk_size: int = 1000
+    ):
+        """キーのリストに対応する行を一括で削除します。
+
+        キーには値（単一のプライマリキー）・タプル・辞書を指定できます。
+        削除した行数を返し、returning=Trueの場合は削除した行のキーを返します。
+        """
+        pks = self.get_primary_keys()
+        keys = (to_keys(self.__class__, x) for x in ids)
+
+        count = 0
+        result = []
+        for chunk in iter_chunks(keys, chunk_size, MAX_BIND_PARAMS):
+            condition = self._keys_condition(pks, [tuple(x.values()) for x in chunk])
+            deleted, deleted_keys = await self._delete_where([condition], returning)
+            count += deleted
+            if returning:
+                result.extend(deleted_keys)
+            self._invalidate(chunk)
+
+        return result if returning else count
+
+    @instrumented
+    async def delete_where(self, *criterion, returning: bool = False):
+        """条件を満たす行を一括で削除します。
+
+        削除した行数を返し、returning=Trueの場合は削除した行のキーを返します。
+        全ての行を削除する場合は、条件に`sa.true()`を明示してください。
+        """
+        if not criterion:
+            raise ValueError("criterion is required.")
+
+        count, keys = await self._delete_where(criterion, returning)
+        # キーを取得しなかった場合は削除した行が分からないので全て破棄する
+        self._invalidate(keys)
+        return keys if returning else count
+
+    async def _delete_where(self, criterion, returning: bool):
+        """削除した行数と、returning=Trueの場合は削除した行のキーを返す"""
+        if not returning:
+            stmt = get_delete(self.__schema__).where(*criterion)
+            cur = await self._execute(stmt.execution_options(**execution_options))
+            return cur.rowcount, None
+
+        if is_returning_supported(self.db):
+            stmt = get_delete_keys(self.__schema__).where(*criterion)
+            keys = [dict(x._mapping) for x in await self._execute(stmt)]
+        else:
+            # returningが利用できない場合は削除する前にキーを取得する
+            stmt = get_select_keys(self.__schema__).where(*criterion)
+            keys = [dict(x._mapping) for x in await self._execute(stmt)]
+            await self._delete_where(criterion, False)
+
+        return len(keys), keys
+
     async def __iter__(self, *criterion, query_builder=lambda stmt: stmt):
-        stmt = self.sql.select().where(*criterion)
+        stmt = self._select().where(*criterion)
         stmt = query_builder(stmt)
-        cur = await self.db.execute(stmt)
-        return (self.output(x) for x in cur.scalars())
+        cur = await self._execute(stmt)
+        output = self._output()
+        return (output(x) for x in self._rows(cur))
 
+    @instrumented_stream
+    async def stream(
+        self,
+        *criterion,
+        chunk_size: int = 1000,
+        query_builder=lambda stmt: stmt,
+    ):
+        """サーバーサイドカーソルを用いて、チャンク毎に取得・変換しながら行を返します。
+
+        async for obj in Person.crud(db).stream(chunk_size=1000):
+            ...
+        """
+        stmt = self._select().where(*criterion)
+        stmt = query_builder(stmt).execution_options(yield_per=chunk_size)
+        cur = await measure_db(self.db.stream(stmt))
+        output = self._output()
+        partitions = self._rows(cur).partitions(chunk_size)
+        try:
+            while True:
+                try:
+                    partition = await measure_db(partitions.__anext__())
+                except StopAsyncIteration:
+                    break
+                for obj in [output(x) for x in partition]:
+                    yield obj
+        finally:
+            await cur.close()
+
+    @instrumented
     async def all(self, *criterion, query_builder=lambda stmt: stmt):
         rows = await self.__iter__(*criterion, query_builder=query_builder)
         return list(rows)
 
+    @instrumented
+    async def query(self, name: str, /, **params) -> list:
+        """スキーマの`__queries__`に定義した名前付きクエリを実行し、結果をリストで返します。
+
+        class Person(BaseModel, Crud[Persons]):
+            __queries__ = {
+                "by_name": lambda stmt, name, limit: stmt.where(Persons.name == name).limit(limit),
+            }
+
+        await Person.crud(db).query("by_name", name="test", limit=10)
+
+        ステートメントは解析時に１度だけ生成され、パラメータは実行時にバインドされます。
+        """
+        stmt, names = get_query(self.__schema__, name)
+        if params.keys() != set(names):
+            raise TypeError(f"{name}() takes parameters {names}, got {tuple(params)}")
+        cur = await self._execute(stmt, params)
+        output = self._output()
+        return [output(x) for x in self._rows(cur)]
+
+    @instrumented
     async def split(
         self,
         *criterion,
         offset: int = 0,
         limit: int = 50,
         query_builder=lambda stmt: stmt,
+        with_total: bool = False,
     ):
+        """offsetとlimitで分割して取得します。with_total=Trueの場合、条件を満たす全件数をtotalに含めます"""
         splitter = lambda stmt: query_builder(stmt).offset(offset).limit(limit)
         result = await self.all(*criterion, query_builder=splitter)
-        return {
+        output = {
             "offset": offset,
             "count": len(result),
             "result": result,
         }
+        if with_total:
+            output["total"] = await self.count(*criterion, query_builder=query_builder)
+        return output
 
+    @instrumented
     async def pagenate(
         self,
         *criterion,
         page: int = 1,
         per_page: int = 50,
         query_builder=lambda stmt: stmt,
+        with_total: bool = False,
     ):
+        """ページ単位で取得します。with_total=Trueの場合、条件を満たす全件数をtotalに含めます"""
         page = max(page, 1)
-        offset = max(page, 0) * per_page
+        offset = (page - 1) * per_page
         pagenate = lambda stmt: query_builder(stmt).offset(offset).limit(per_page)
         result = await self.all(*criterion, query_builder=pagenate)
-        return {
+        output = {
             "page": page,
             "count": len(result),
             "result": result,
         }
+        if with_total:
+            output["total"] = await self.count(*criterion, query_builder=query_builder)
+        return output
+
+    @instrumented
+    async def seek(
+        self,
+        *criterion,
+        after: str = None,
+        limit: int = 50,
+        order_by: List[Any] = None,
+        query_builder=lambda stmt: stmt,
+    ):
+        """キーセット（カーソル）ページネーションを行います。
+
+        `order_by`にはカラム・カラム名（"-name"で降順）・`desc(column)`を指定でき、
+        省略時はプライマリキーの昇順になります。
+        次のページを取得するには、戻り値の`next`を`after`に指定してください。
+        """
+        orders = get_seek_order(self.__class__, order_by)
+        stmt = self._select().where(*criterion)
+
+        projection = is_projection(self.__schema__)
+        if projection:
+            # カーソルの生成に必要なカラムがスキーマに含まれない場合は追加で取得する
+            names = set(stmt.selected_columns.keys())
+            stmt = stmt.add_columns(*(x for x, desc in orders if x.key not in names))
+        else:
+            # エンティティはスキーマが宣言したカラムのみ読み込むので、カーソルに使うカラムは行に追加して取得する
+            stmt = stmt.add_columns(*(x for x, desc in orders))
+
+        if after is not None:
+            stmt = stmt.where(get_seek_condition(orders, decode_cursor(after)))
+
+        stmt = stmt.order_by(*(x.desc() if desc else x for x, desc in orders))
+        stmt = query_builder(stmt).limit(limit + 1)
+        cur = await self._execute(stmt)
+        rows = cur.all()
+
+        if len(rows) > limit:
+            rows = rows[:limit]
+            last = rows[-1]
+            if projection:
+                values = [getattr(last, x.key) for x, desc in orders]
+            else:
+                values = list(last[1:])
+            next_cursor = encode_cursor(values)
+        else:
+            next_cursor = None
+
+        output = self._output()
+        result = [output(x if projection else x[0]) for x in rows]
+        return {
+            "after": after,
+            "next": next_cursor,
+            "count": len(result),
+            "result": result,
+        }
+
+
+def synchronize(name: str):
+    method = getattr(DynamimcAsyncCrud, name)
+
+    def wrapper(self, *args, **kwargs):
+        return run(getattr(self.crud, name)(*args, **kwargs))
+
+    wrapper.__name__ = wrapper.__qualname__ = name
+    wrapper.__doc__ = method.__doc__
+    return wrapper
+
+
+class DynamicSyncCrud(Generic[T]):
+    """同期セッションで利用するCrud。`Schema.crud_sync(session)`で生成します。
+
+    DynamimcAsyncCrudの処理を、中断しないセッションのアダプタを通じてイベントループを使わずに実行するので、
+    解析結果・ステートメント・変換関数のキャッシュは非同期版と共有されます。
+    """
+
+    __schema__: Type[T]
+
+    @classmethod
+    def _create_class(
+        cls: Type["DynamicSyncCrud"], schema: Type
+    ) -> "DynamicSyncCrud[S]":
+        class DynamicCrud(cls[schema]):  # type: ignore
+            ...
+
+        return DynamicCrud  # type: ignore
+
+    def __init_subclass__(cls, *args, **kwargs):
+        cls.__schema__ = get_own_or_generics(cls, DynamicSyncCrud)
+
+    def __init__(self, db: Session):
+        self.db = db
+        self.crud = self.__schema__.crud(SessionAdapter(db))
+
+    get_or_none = synchronize("get_or_none")
+    get_many_or_none = synchronize("get_many_or_none")
+    get_many = synchronize("get_many")
+    undefer = synchronize("undefer")
+    undefer_many = synchronize("undefer_many")
+    get = synchronize("get")
+    exist = synchronize("exist")
+    exists = synchronize("exists")
+    count = synchronize("count")
+    create = synchronize("create")
+    create_many = synchronize("create_many")
+    upsert = synchronize("upsert")
+    upsert_many = synchronize("upsert_many")
+    update_or_pass = synchronize("update_or_pass")
+    update = synchronize("update")
+    delete_or_pass = synchronize("delete_or_pass")
+    delete = synchronize("delete")
+    update_many = synchronize("update_many")
+    delete_many = synchronize("delete_many")
+    delete_where = synchronize("delete_where")
+    all = synchronize("all")
+    query = synchronize("query")
+    split = synchronize("split")
+    pagenate = synchronize("pagenate")
+    seek = synchronize("seek")
+
+    def stream(self, *criterion, chunk_size: int = 1000, query_builder=lambda x: x):
+        generator = self.crud.stream(
+            *criterion, chunk_size=chunk_size, query_builder=query_builder
+        )
+        try:
+            while True:
+                try:
+                    obj = run(generator.__anext__())
+                except StopAsyncIteration:
+                    return
+                yield obj
+        finally:
+            run(generator.aclose())
@@ -0,0 +1,202 @@
+import pickle
+from collections import OrderedDict
+from time import monotonic
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+from sqlalchemy import event
+from sqlalchemy.exc import MissingGreenlet
+from sqlalchemy.orm import Session
+from sqlalchemy.util import await_only
+
+from .sync import run
+
+
+class CacheBackend:
+    """getの結果を保持する保存先。値がない場合、getはNoneを返してください。
+
+    crud_syncはイベントループを使わずに実行するので、実際にI/Oを待機するバックエンドは同期のcrudでは使えません。
+    同期のcrudと共有するスキーマには、MemoryBackendのように待機せずに完了するバックエンドを設定してください
+    """
+
+    async def get(self, key: str) -> Any:
+        raise NotImplementedError()
+
+    async def set(self, key: str, value: Any, ttl: float):
+        raise NotImplementedError()
+
+    async def delete(self, keys: Iterable[str]):
+        raise NotImplementedError()
+
+    async def clear(self, prefix: str = ""):
+        """prefixで始まるキーを全て削除する"""
+        raise NotImplementedError()
+
+
+class MemoryBackend(CacheBackend):
+    """プロセス内のLRUキャッシュ。保持したオブジェクトをそのまま返すので、変更しないでください"""
+
+    def __init__(self, maxsize: int = 1024):
+        self.maxsize = maxsize
+        self.store: "OrderedDict[str, Tuple[float, Any]]" = OrderedDict()
+
+    def dumps(self, value):
+        return value
+
+    def loads(self, value):
+        return value
+
+    async def get(self, key: str) -> Any:
+        entry = self.store.get(key)
+        if entry is None:
+            return None
+
+        expires, value = entry
+        if expires <= monotonic():
+            del self.store[key]
+            return None
+
+        self.store.move_to_end(key)
+        return self.loads(value)
+
+    async def set(self, key: str, value: Any, ttl: float):
+        self.store[key] = (monotonic() + ttl, self.dumps(value))
+        self.store.move_to_end(key)
+        while len(self.store) > self.maxsize:
+            self.store.popitem(last=False)
+
+    async def delete(self, keys: Iterable[str]):
+        for key in keys:
+            self.store.pop(key, None)
+
+    async def clear(self, prefix: str = ""):
+        for key in [x for x in self.store if x.startswith(prefix)]:
+            del self.store[key]
+
+
+class SharedBackend(MemoryBackend):
+    """Redisなどの共有キャッシュの代わりに、値をpickleしたバイト列で保持する。
+
+    storeに同じdictを渡したバックエンド間でエントリを共有し、取得の度に新しいオブジェクトを返す
+    """
+
+    def __init__(self, maxsize: int = 1024, store: OrderedDict = None):
+        super().__init__(maxsize)
+        if store is not None:
+            self.store = store
+
+    def dumps(self, value):
+        return pickle.dumps(value)
+
+    def loads(self, value):
+        return pickle.loads(value)
+
+
+class ResultCache:
+    """スキーマの`__cache__`に設定すると、getの結果をプライマリキー毎にttl秒キャッシュする。
+
+    同じエンティティのCrudで更新・削除・upsertした行のエントリは、コミットした後に破棄される。
+    取得しなかったキーはキャッシュしないので、挿入では破棄しない。
+    Crudで書き込んだセッションでは、ロールバックで破棄されうる値をキャッシュしないよう、
+    コミットまたはロールバックするまでキャッシュを使わない。
+    crud_syncで使う場合、バックエンドは待機せずに完了する必要がある（CacheBackendを参照）
+    """
+
+    def __init__(
+        self, backend: CacheBackend = None, *, ttl: float = 60.0, maxsize: int = 1024
+    ):
+        self.backend = MemoryBackend(maxsize) if backend is None else backend
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def get_prefix(schema) -> str:
+        return f"sqlalchemy14:{schema.__module__}.{schema.__qualname__}:"
+
+    def get_key(self, schema, keys: dict) -> str:
+        return self.get_prefix(schema) + repr(tuple(keys.values()))
+
+    async def get(self, schema, keys: dict) -> Any:
+        value = await self.backend.get(self.get_key(schema, keys))
+        if value is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return value
+
+    async def set(self, schema, keys: dict, value: Any):
+        await self.backend.set(self.get_key(schema, keys), value, self.ttl)
+
+    async def invalidate(self, schema, keys: List[dict] = None):
+        """キーのエントリを破棄する。キーを指定しない場合はスキーマの全てのエントリを破棄する"""
+        if keys is None:
+            await self.backend.clear(self.get_prefix(schema))
+        else:
+            await self.backend.delete([self.get_key(schema, x) for x in keys])
+
+
+# ResultCacheが設定されたスキーマ。エンティティ毎に保持する
+cached_schemas: Dict[type, List[type]] = {}
+
+
+def register_cache(schema):
+    if not event.contains(Session, "after_commit", after_commit):
+        event.listen(Session, "after_commit", after_commit)
+
+    schemas = cached_schemas.setdefault(schema.__entity__, [])
+    if schema not in schemas:
+        schemas.append(schema)
+
+
+async def invalidate(entity, keys: Optional[List[dict]] = None):
+    """エンティティの行を返す全てのスキーマのキャッシュから、キーのエントリを破棄する"""
+    for schema in cached_schemas.get(entity, ()):
+        await schema.__cache__.invalidate(schema, keys)
+
+
+# Crudで書き込んだトランザクションと、コミット後に破棄する(エンティティ, キー)を保持するSession.infoのキー
+WRITTEN_KEY = "sqlalchemy14.cache.written"
+
+
+def mark_written(session, entity=None, keys: Optional[List[dict]] = None):
+    """セッションの現在のトランザクションで書き込んだことを記録する。
+
+    エンティティを指定した場合は、コミット後にキーのエントリを破棄する。
+    書き込みの時点で破棄すると、コミットまでに他のセッションが取得した古い値がキャッシュされるため
+    """
+    # 最初の文の実行前はトランザクションが開始されていないので、書き込む前に開始しておく
+    transaction = session.get_transaction()
+    if transaction is None:
+        transaction = session.begin()
+
+    written = session.info.get(WRITTEN_KEY)
+    if written is None or written[0] is not transaction:
+        written = session.info[WRITTEN_KEY] = (transaction, [])
+    if entity in cached_schemas:
+        written[1].append((entity, keys))
+
+
+def is_written(session) -> bool:
+    """セッションにコミットしていないCrudの書き込みがあるか"""
+    transaction = session.get_transaction()
+    written = session.info.get(WRITTEN_KEY)
+    return transaction is not None and written is not None and written[0] is transaction
+
+
+async def invalidate_written(written: List[Tuple[type, Optional[List[dict]]]]):
+    for entity, keys in written:
+        await invalidate(entity, keys)
+
+
+def after_commit(session):
+    """コミットしたトランザクションで書き込んだ行のエントリを破棄する"""
+    written = session.info.pop(WRITTEN_KEY, None)
+    if written is None or not written[1]:
+        return
+
+    coro = invalidate_written(written[1])
+    try:
+        # AsyncSessionのコミットはgreenlet内で実行されるので、イベントループで待機できる
+        await_only(coro)
+    except MissingGreenlet:
+        run(coro)
@@ -0,0 +1,106 @@
+from dataclasses import is_dataclass
+from inspect import isclass
+from typing import Callable
+
+from pydantic import BaseModel
+from pydantic.fields import SHAPE_SINGLETON
+
+from .analyzer import analyze, get_columns
+from .registry import cached
+
+object_setattr = object.__setattr__
+
+
+def is_trusted(cls) -> bool:
+    """DBから取得した値を検証せずにスキーマへ変換するか。`__trusted__ = True`で検証を省略する"""
+    return getattr(cls, "__trusted__", False)
+
+
+def has_validators(cls) -> bool:
+    """値を変換するバリデータを持つか。信頼モードでもバリデータを省略しない"""
+    return bool(
+        cls.__validators__
+        or cls.__pre_root_validators__
+        or cls.__post_root_validators__
+    )
+
+
+@cached()
+def get_converter(cls, trusted: bool = True) -> Callable:
+    """ORMオブジェクト（属性を持つオブジェクト）をスキーマに変換する関数を生成する"""
+    if issubclass(cls, BaseModel) and (not trusted or has_validators(cls)):
+        return cls.from_orm
+
+    getters = []
+    for name in get_columns(cls):  # type: ignore
+        getters.append((name, get_nested_converter(cls, name, trusted)))
+
+    create = get_constructor(cls)
+
+    def convert(obj):
+        values = {}
+        for name, nested in getters:
+            value = getattr(obj, name)
+            values[name] = value if nested is None else nested(value)
+        return create(values)
+
+    return convert
+
+
+@cached()
+def get_row_converter(cls, trusted: bool = True) -> Callable:
+    """returningやカラムのみのselectで取得した行をスキーマに変換する関数を生成する。
+
+    行の先頭には解析で得たreturningの順にカラムが並んでいることを前提に、位置で値を取得する。
+    行の列名はカラム名で属性名と異なる場合があるので、検証する場合も位置で取得した値を検証する
+    """
+    entity, returning, primary_keys, load_strategies = analyze(cls)
+    indexes = [(x.key, i) for i, x in enumerate(returning)]
+    if issubclass(cls, BaseModel) and (not trusted or has_validators(cls)):
+        create = cls.parse_obj
+    else:
+        create = get_constructor(cls)
+
+    def convert(row):
+        return create({name: row[i] for name, i in indexes})
+
+    return convert
+
+
+def get_nested_converter(cls, name: str, trusted: bool):
+    if not issubclass(cls, BaseModel):
+        return None
+
+    field = cls.__fields__[name]
+    if not isclass(field.type_):
+        return None
+    elif not (issubclass(field.type_, BaseModel) or is_dataclass(field.type_)):
+        return None
+
+    convert = get_converter(field.type_, trusted)
+
+    if field.shape == SHAPE_SINGLETON:
+        return lambda value: None if value is None else convert(value)
+    else:
+        return lambda values: [convert(x) for x in values]
+
+
+def get_constructor(cls) -> Callable:
+    """検証を行わずにインスタンスを生成する関数を返す"""
+    if is_dataclass(cls):
+        return lambda values: cls(**values)
+
+    assert issubclass(cls, BaseModel)
+    fields_set = frozenset(cls.__fields__)
+    has_private_attributes = bool(cls.__private_attributes__)
+
+    # BaseModel.constructと同様だが、全てのフィールドの値が揃っているのでデフォルト値の解決を省略する
+    def create(values):
+        obj = cls.__new__(cls)
+        object_setattr(obj, "__dict__", values)
+        object_setattr(obj, "__fields_set__", set(fields_set))
+        if has_private_attributes:
+            obj._init_private_attributes()
+        return obj
+
+    return create
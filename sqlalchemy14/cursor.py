@@ -0,0 +1,44 @@
+import base64
+import json
+from datetime import date, datetime, time
+from decimal import Decimal
+from uuid import UUID
+
+# asyncpgはパラメータの型を厳密に扱うので、jsonで表現できない型は型名と共に保存する
+TYPES = {
+    "datetime": (datetime, datetime.isoformat, datetime.fromisoformat),
+    "date": (date, date.isoformat, date.fromisoformat),
+    "time": (time, time.isoformat, time.fromisoformat),
+    "decimal": (Decimal, str, Decimal),
+    "uuid": (UUID, str, UUID),
+}
+
+
+def encode_value(value):
+    for name, (type_, dump, load) in TYPES.items():
+        if isinstance(value, type_):
+            return {"t": name, "v": dump(value)}
+
+    return value
+
+
+def decode_value(value):
+    if isinstance(value, dict):
+        type_, dump, load = TYPES[value["t"]]
+        return load(value["v"])
+
+    return value
+
+
+def encode_cursor(values) -> str:
+    """キーセットページネーションの位置を不透明な文字列に変換する"""
+    data = json.dumps([encode_value(x) for x in values], separators=(",", ":"))
+    return base64.urlsafe_b64encode(data.encode()).decode()
+
+
+def decode_cursor(cursor: str) -> list:
+    try:
+        data = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        return [decode_value(x) for x in data]
+    except Exception as e:
+        raise ValueError(f"invalid cursor: {cursor}") from e
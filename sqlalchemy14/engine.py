@@ -1,16 +1,407 @@
+from dataclasses import asdict, dataclass, field
+from functools import lru_cache
+from itertools import count
+from time import perf_counter
+from typing import Any, Dict, List, Optional, Sequence
+from uuid import uuid4
+
 import sqlalchemy as sa
-from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
+from sqlalchemy.engine import make_url
+from sqlalchemy.ext.asyncio import AsyncEngine, AsyncSession, create_async_engine
+from sqlalchemy.orm import Session
+from sqlalchemy.sql import Select
+
+from .slow_query import SlowQueryRecorder
+
+
+@dataclass
+class PoolConfig:
+    """コネクションプールの設定。Noneの項目はSQLAlchemyの既定値を用いる"""
+
+    pool_size: Optional[int] = None
+    max_overflow: Optional[int] = None
+    pool_timeout: Optional[float] = None
+    pool_recycle: Optional[int] = None
+    pool_pre_ping: Optional[bool] = None
+    pool_use_lifo: Optional[bool] = None
+
+    def get_options(self) -> dict:
+        return {k: v for k, v in asdict(self).items() if v is not None}
+
+
+@dataclass
+class DriverConfig:
+    """ドライバの設定。
+
+    pgbouncer=Trueの場合、トランザクションプーリングモードのPgBouncerを経由しても
+    プリペアドステートメントが衝突しないよう、キャッシュを無効にし、ステートメント名を一意にする
+    """
+
+    # SQLAlchemyのasyncpgアダプタが接続毎に保持するプリペアドステートメント数
+    prepared_statement_cache_size: Optional[int] = None
+    # asyncpg自身のステートメントキャッシュのサイズ
+    statement_cache_size: Optional[int] = None
+    pgbouncer: bool = False
+    connect_args: Dict[str, Any] = field(default_factory=dict)
+
+    def is_asyncpg_specific(self) -> bool:
+        return (
+            self.pgbouncer
+            or self.prepared_statement_cache_size is not None
+            or self.statement_cache_size is not None
+        )
+
+    def get_url(self, url):
+        size = 0 if self.pgbouncer else self.prepared_statement_cache_size
+        if size is None:
+            return url
+        return url.update_query_dict({"prepared_statement_cache_size": str(size)})
+
+    def get_connect_args(self) -> dict:
+        connect_args = dict(self.connect_args)
+        if self.pgbouncer:
+            connect_args["statement_cache_size"] = 0
+            connect_args["connection_class"] = get_pgbouncer_connection_class()
+        elif self.statement_cache_size is not None:
+            connect_args["statement_cache_size"] = self.statement_cache_size
+        return connect_args
+
+
+@lru_cache()
+def get_pgbouncer_connection_class():
+    import asyncpg
+
+    class PgBouncerConnection(asyncpg.Connection):
+        """プリペアドステートメント名をプロセスを跨いで一意にする。
+
+        PgBouncerはサーバー接続を複数のクライアントで共有するため、連番の名前では衝突する
+        """
+
+        def _get_unique_id(self, prefix):
+            return f"__asyncpg_{prefix}_{uuid4().hex}__"
+
+    return PgBouncerConnection
+
+
+class PoolMetrics:
+    """プールの利用状況。
+
+    checked_out、overflow、sizeは現在値、それ以外はメトリクス作成後の累計（秒）。
+    待ち時間はプールから接続を取得するまでの時間で、新たな接続の確立やpre pingを含む
+    """
+
+    def __init__(self):
+        self.pool: Optional[sa.pool.Pool] = None
+        self.reset()
+
+    def reset(self):
+        self.checkouts = 0
+        self.timeouts = 0
+        self.wait_time = 0.0
+        self.max_wait_time = 0.0
+        self.connects = 0
+        self.connect_time = 0.0
+        self.max_connect_time = 0.0
+
+    def get_pool_status(self, name: str) -> Optional[int]:
+        # NullPoolなどは接続数を管理しない
+        func = getattr(self.pool, name, None)
+        return None if func is None else func()
+
+    @property
+    def checked_out(self) -> Optional[int]:
+        return self.get_pool_status("checkedout")
+
+    @property
+    def overflow(self) -> Optional[int]:
+        return self.get_pool_status("overflow")
+
+    @property
+    def size(self) -> Optional[int]:
+        return self.get_pool_status("size")
+
+    def record_wait(self, elapsed: float):
+        self.checkouts += 1
+        self.wait_time += elapsed
+        if elapsed > self.max_wait_time:
+            self.max_wait_time = elapsed
+
+    def record_connect(self, elapsed: float):
+        self.connects += 1
+        self.connect_time += elapsed
+        if elapsed > self.max_connect_time:
+            self.max_connect_time = elapsed
+
+    def snapshot(self) -> dict:
+        return {
+            "size": self.size,
+            "checked_out": self.checked_out,
+            "overflow": self.overflow,
+            "checkouts": self.checkouts,
+            "timeouts": self.timeouts,
+            "wait_time": self.wait_time,
+            "max_wait_time": self.max_wait_time,
+            "connects": self.connects,
+            "connect_time": self.connect_time,
+            "max_connect_time": self.max_connect_time,
+        }
+
+
+class MeasuredPool:
+    """プールクラスに混ぜて接続の取得時間を計測する"""
+
+    metrics: PoolMetrics
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # disposeでプールが再作成されても、最新のプールの状態を参照する
+        self.metrics.pool = self
+
+    def connect(self):
+        start = perf_counter()
+        try:
+            return super().connect()
+        except sa.exc.TimeoutError:
+            self.metrics.timeouts += 1
+            raise
+        finally:
+            self.metrics.record_wait(perf_counter() - start)
+
+
+def get_measured_pool_class(pool_class, metrics: PoolMetrics):
+    return type(
+        f"Measured{pool_class.__name__}",
+        (MeasuredPool, pool_class),
+        {"metrics": metrics},
+    )
+
+
+def listen_connect(engine: sa.engine.Engine, metrics: PoolMetrics):
+    key = "sqlalchemy14.connect_start"
+
+    @sa.event.listens_for(engine, "do_connect")
+    def on_do_connect(dialect, conn_rec, cargs, cparams):
+        conn_rec.info[key] = perf_counter()
 
+    @sa.event.listens_for(engine, "connect")
+    def on_connect(dbapi_connection, connection_record):
+        start = connection_record.info.pop(key, None)
+        if start is not None:
+            metrics.record_connect(perf_counter() - start)
 
-def create_engine(connection_string: str, class_=AsyncSession):
+
+def get_pool_metrics(engine) -> Optional[PoolMetrics]:
+    """create_engineで作成したエンジンのプールのメトリクスを返す"""
+    if isinstance(engine, AsyncEngine):
+        engine = engine.sync_engine
+    return getattr(engine.pool, "metrics", None)
+
+
+def create_engine(
+    connection_string: str,
+    class_=AsyncSession,
+    *,
+    pool_config: PoolConfig = None,
+    driver_config: DriverConfig = None,
+    slow_query: SlowQueryRecorder = None,
+    **kwargs,
+):
+    """エンジンとセッションファクトリを作成する。
+
+    プールのメトリクスはget_pool_metrics(engine)で取得できる。
+    slow_queryを指定すると、エンジンで実行される遅い文を記録する。
+    その他の引数はそのままcreate_async_engineに渡される
+    """
     assert issubclass(class_, AsyncSession)
-    engine = create_async_engine(connection_string)
-    create_session = sa.orm.sessionmaker(
+    url, options, metrics = get_engine_options(
+        connection_string, pool_config, driver_config, kwargs
+    )
+    engine = create_async_engine(url, **options)
+    if metrics is not None:
+        listen_connect(engine.sync_engine, metrics)
+    if slow_query is not None:
+        slow_query.attach(engine)
+
+    return engine, get_session_factory(engine, class_)
+
+
+def create_sync_engine(
+    connection_string: str,
+    class_=Session,
+    *,
+    pool_config: PoolConfig = None,
+    driver_config: DriverConfig = None,
+    **kwargs,
+):
+    """同期エンジンとセッションファクトリを作成する。バッチ処理などでcrud_syncと共に利用する。
+
+    その他の引数はそのままsqlalchemy.create_engineに渡される
+    """
+    assert issubclass(class_, Session)
+    url, options, metrics = get_engine_options(
+        connection_string, pool_config, driver_config, kwargs
+    )
+    engine = sa.create_engine(url, future=True, **options)
+    if metrics is not None:
+        listen_connect(engine, metrics)
+
+    return engine, get_session_factory(engine, class_)
+
+
+def get_engine_options(
+    connection_string: str,
+    pool_config: Optional[PoolConfig],
+    driver_config: Optional[DriverConfig],
+    kwargs: dict,
+):
+    url = make_url(connection_string)
+    options = {**(pool_config or PoolConfig()).get_options(), **kwargs}
+
+    if driver_config is not None:
+        if driver_config.is_asyncpg_specific() and url.get_driver_name() != "asyncpg":
+            raise ValueError(
+                f"Statement cache options require asyncpg: {url.drivername}"
+            )
+        url = driver_config.get_url(url)
+        options["connect_args"] = {
+            **driver_config.get_connect_args(),
+            **options.get("connect_args", {}),
+        }
+
+    # プールのインスタンスが渡された場合は計測しない
+    metrics = None
+    if "pool" not in options:
+        metrics = PoolMetrics()
+        pool_class = options.get("poolclass") or url.get_dialect().get_pool_class(url)
+        options["poolclass"] = get_measured_pool_class(pool_class, metrics)
+
+    return url, options, metrics
+
+
+def get_session_factory(engine, class_=AsyncSession, **kwargs):
+    return sa.orm.sessionmaker(
         bind=engine,
         autocommit=False,
         autoflush=False,
         expire_on_commit=False,
-        class_=AsyncSession,
+        class_=class_,
         future=True,
+        **kwargs,
+    )
+
+
+class EngineRouter:
+    """プライマリとレプリカのエンジンを保持し、読み取りに用いるレプリカを選択する"""
+
+    strategies = ("round_robin", "least_connections")
+
+    def __init__(
+        self,
+        primary: AsyncEngine,
+        replicas: Sequence[AsyncEngine],
+        strategy: str = "round_robin",
+    ):
+        if strategy not in self.strategies:
+            raise ValueError(f"Unknown strategy: {strategy}")
+        self.primary = primary
+        self.replicas: List[AsyncEngine] = list(replicas)
+        self.strategy = strategy
+        self.counter = count()
+
+    def get_replica(self) -> AsyncEngine:
+        if not self.replicas:
+            return self.primary
+        elif self.strategy == "round_robin":
+            return self.replicas[next(self.counter) % len(self.replicas)]
+        else:
+            return min(self.replicas, key=get_checked_out)
+
+    async def dispose(self):
+        for engine in [self.primary, *self.replicas]:
+            await engine.dispose()
+
+
+def get_checked_out(engine: AsyncEngine) -> int:
+    checkedout = getattr(engine.sync_engine.pool, "checkedout", None)
+    return 0 if checkedout is None else checkedout()
+
+
+def is_read(clause) -> bool:
+    # テキストなど判別できない文は書き込みとみなす
+    return isinstance(clause, Select) and clause._for_update_arg is None
+
+
+class RoutingSession(Session):
+    """読み取りをレプリカ、書き込みをプライマリで実行するセッション。
+
+    フラッシュ・DML・行ロックを伴うselect・明示的に開始したトランザクションはプライマリで実行し、
+    トランザクションが終わるまで以降の読み取りもプライマリで行う。
+    read_your_writes=Trueの場合は、セッションが破棄されるまでプライマリで読み取る
+    """
+
+    def __init__(self, *args, router: EngineRouter, read_your_writes=False, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.router = router
+        self.read_your_writes = read_your_writes
+        self.use_primary = False
+        self.replica: Optional[sa.engine.Engine] = None
+
+    def begin(self, *args, **kwargs):
+        if self._transaction is None:
+            self.use_primary = True
+        return super().begin(*args, **kwargs)
+
+    def get_bind(self, mapper=None, clause=None, **kwargs):
+        if self.use_primary or self._flushing or not is_read(clause):
+            self.use_primary = True
+            return self.router.primary.sync_engine
+
+        # １つのトランザクションでは同じレプリカを使う
+        if self.replica is None:
+            self.replica = self.router.get_replica().sync_engine
+        return self.replica
+
+
+@sa.event.listens_for(RoutingSession, "after_transaction_end")
+def reset_routing(session: RoutingSession, transaction):
+    if transaction.parent is None:
+        session.replica = None
+        if not session.read_your_writes:
+            session.use_primary = False
+
+
+def create_routing_engine(
+    primary: str,
+    replicas: Sequence[str],
+    class_=AsyncSession,
+    *,
+    strategy: str = "round_robin",
+    read_your_writes: bool = False,
+    pool_config: PoolConfig = None,
+    driver_config: DriverConfig = None,
+    **kwargs,
+):
+    """プライマリとレプリカのエンジンを作成し、読み書きを振り分けるセッションファクトリを返す。
+
+    レプリカの選択はround_robinかleast_connections（貸出中の接続が最も少ないもの）から選ぶ
+    """
+    assert issubclass(class_, AsyncSession)
+    engines = [
+        create_engine(
+            x,
+            class_,
+            pool_config=pool_config,
+            driver_config=driver_config,
+            **kwargs,
+        )[0]
+        for x in [primary, *replicas]
+    ]
+    router = EngineRouter(engines[0], engines[1:], strategy)
+    create_session = get_session_factory(
+        router.primary,
+        class_,
+        sync_session_class=RoutingSession,
+        router=router,
+        read_your_writes=read_your_writes,
     )
-    return engine, create_session
+    return router, create_session
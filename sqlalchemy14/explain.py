@@ -0,0 +1,25 @@
+import json
+
+from sqlalchemy.ext.compiler import compiles
+from sqlalchemy.sql.expression import ClauseElement, Executable
+
+
+class Explain(Executable, ClauseElement):
+    """ステートメントの実行計画をEXPLAIN (FORMAT JSON)で取得する。PostgreSQL専用"""
+
+    inherit_cache = False
+
+    def __init__(self, statement):
+        self.statement = statement
+
+
+@compiles(Explain, "postgresql")
+def compile_explain(element, compiler, **kw):
+    return "EXPLAIN (FORMAT JSON) " + compiler.process(element.statement, **kw)
+
+
+def get_plan(result) -> dict:
+    """EXPLAINの結果から最上位のプランを返す"""
+    if isinstance(result, str):
+        result = json.loads(result)
+    return result[0]["Plan"]
@@ -0,0 +1,303 @@
+from bisect import bisect_left
+from contextvars import ContextVar
+from dataclasses import dataclass, field
+from functools import wraps
+from time import perf_counter, time_ns
+from typing import Dict, List, Optional, Tuple
+
+import sqlalchemy as sa
+
+
+@dataclass
+class Operation:
+    """Crudの１回の呼び出しで計測した値。時間は秒"""
+
+    name: str
+    schema: str
+    # 開始時刻（エポックからのナノ秒）
+    start_time: int = 0
+    duration: float = 0.0
+    # セッションでの実行（コンパイル・結果の取得を含む）に要した時間
+    db_time: float = 0.0
+    # 行をスキーマに変換するのに要した時間
+    conversion_time: float = 0.0
+    # 変換して返した行数
+    rows: int = 0
+    round_trips: int = 0
+    # 実行した文の種類（select・insertなど）
+    statements: List[str] = field(default_factory=list)
+    error: Optional[BaseException] = None
+
+
+class Sink:
+    """計測結果の送り先。recordは例外を送出しないでください"""
+
+    def record(self, operation: Operation):
+        raise NotImplementedError()
+
+
+# 登録されたシンク。空の場合は計測しない
+sinks: List[Sink] = []
+
+# 計測中の操作。ネストしたCrudの呼び出しは外側の操作に計上する
+current: ContextVar[Optional[Operation]] = ContextVar(
+    "sqlalchemy14.operation", default=None
+)
+
+
+def add_sink(sink: Sink):
+    if not sinks:
+        sa.event.listen(sa.engine.Engine, "before_cursor_execute", count_round_trip)
+    sinks.append(sink)
+
+
+def remove_sink(sink: Sink):
+    sinks.remove(sink)
+    if not sinks:
+        sa.event.remove(sa.engine.Engine, "before_cursor_execute", count_round_trip)
+
+
+def count_round_trip(conn, cursor, statement, parameters, context, executemany):
+    # フラッシュなどセッションが内部で発行する文も含めて数える
+    operation = current.get()
+    if operation is not None:
+        operation.round_trips += 1
+        operation.statements.append(statement.lstrip().split(None, 1)[0].lower())
+
+
+async def measure_db(awaitable):
+    operation = current.get()
+    if operation is None:
+        return await awaitable
+
+    start = perf_counter()
+    try:
+        return await awaitable
+    finally:
+        operation.db_time += perf_counter() - start
+
+
+def measure_conversion(convert):
+    def wrapper(row):
+        operation = current.get()
+        if operation is None:
+            return convert(row)
+
+        start = perf_counter()
+        try:
+            return convert(row)
+        finally:
+            operation.conversion_time += perf_counter() - start
+            operation.rows += 1
+
+    return wrapper
+
+
+def start_operation(crud, name: str) -> Operation:
+    # 計測時のみ、インスタンスの変換関数を計測するものに置き換える
+    if "output" not in crud.__dict__:
+        crud.output = measure_conversion(type(crud).output)
+        crud.output_row = measure_conversion(type(crud).output_row)
+    return Operation(name=name, schema=crud.__schema__.__name__, start_time=time_ns())
+
+
+def finish_operation(operation: Operation, start: float):
+    operation.duration = perf_counter() - start
+    for sink in sinks:
+        sink.record(operation)
+
+
+def instrumented(func):
+    """Crudのメソッドを計測する。シンクが無い場合や、計測中の操作から呼ばれた場合はそのまま実行する"""
+
+    @wraps(func)
+    async def wrapper(self, *args, **kwargs):
+        if not sinks or current.get() is not None:
+            return await func(self, *args, **kwargs)
+
+        operation = start_operation(self, func.__name__)
+        start = perf_counter()
+        token = current.set(operation)
+        try:
+            return await func(self, *args, **kwargs)
+        except BaseException as e:
+            operation.error = e
+            raise
+        finally:
+            current.reset(token)
+            finish_operation(operation, start)
+
+    return wrapper
+
+
+def instrumented_stream(func):
+    """非同期ジェネレータを計測する。呼び出し側のコードを計上しないよう、行の取得中のみ計測中とする"""
+
+    @wraps(func)
+    async def wrapper(self, *args, **kwargs):
+        if not sinks or current.get() is not None:
+            async for obj in func(self, *args, **kwargs):
+                yield obj
+            return
+
+        operation = start_operation(self, func.__name__)
+        start = perf_counter()
+        generator = func(self, *args, **kwargs)
+        try:
+            while True:
+                token = current.set(operation)
+                try:
+                    obj = await generator.__anext__()
+                except StopAsyncIteration:
+                    break
+                finally:
+                    current.reset(token)
+                yield obj
+        except BaseException as e:
+            operation.error = e
+            raise
+        finally:
+            token = current.set(operation)
+            try:
+                await generator.aclose()
+            finally:
+                current.reset(token)
+                finish_operation(operation, start)
+
+    return wrapper
+
+
+DEFAULT_BUCKETS = (
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.075,
+    0.1,
+    0.25,
+    0.5,
+    0.75,
+    1.0,
+    2.5,
+    5.0,
+    7.5,
+    10.0,
+    float("inf"),
+)
+
+COUNT_BUCKETS = (1, 2, 3, 5, 10, 20, 50, 100, float("inf"))
+
+
+class Histogram:
+    def __init__(self, buckets: Tuple[float, ...]):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def cumulative_counts(self) -> List[int]:
+        result, total = [], 0
+        for x in self.counts:
+            total += x
+            result.append(total)
+        return result
+
+
+def format_bound(value: float) -> str:
+    return "+Inf" if value == float("inf") else repr(float(value))
+
+
+class HistogramSink(Sink):
+    """操作とスキーマ毎にヒストグラムを集計し、Prometheusのテキスト形式で出力する"""
+
+    metrics = {
+        "duration_seconds": ("duration", "Time spent in a crud operation."),
+        "db_seconds": ("db_time", "Time spent executing statements."),
+        "conversion_seconds": ("conversion_time", "Time spent converting rows."),
+        "round_trips": ("round_trips", "Statements executed per operation."),
+        "rows": ("rows", "Rows returned per operation."),
+    }
+
+    def __init__(
+        self,
+        prefix: str = "sqlalchemy14_operation",
+        buckets: Tuple[float, ...] = DEFAULT_BUCKETS,
+    ):
+        self.prefix = prefix
+        self.buckets = buckets
+        self.histograms: Dict[Tuple[str, Tuple[str, str]], Histogram] = {}
+        self.errors: Dict[Tuple[str, str], int] = {}
+
+    def get_buckets(self, name: str) -> Tuple[float, ...]:
+        if name in ("round_trips", "rows"):
+            return COUNT_BUCKETS
+        return self.buckets
+
+    def record(self, operation: Operation):
+        labels = (operation.name, operation.schema)
+        for name, (attr, description) in self.metrics.items():
+            histogram = self.histograms.get((name, labels))
+            if histogram is None:
+                histogram = Histogram(self.get_buckets(name))
+                self.histograms[(name, labels)] = histogram
+            histogram.observe(getattr(operation, attr))
+
+        if operation.error is not None:
+            self.errors[labels] = self.errors.get(labels, 0) + 1
+
+    def render(self) -> str:
+        lines = []
+        for name, (attr, description) in self.metrics.items():
+            metric = f"{self.prefix}_{name}"
+            lines.append(f"# HELP {metric} {description}")
+            lines.append(f"# TYPE {metric} histogram")
+            for (key, labels), histogram in self.histograms.items():
+                if key != name:
+                    continue
+                label = 'operation="{}",schema="{}"'.format(*labels)
+                for bound, count in zip(
+                    histogram.buckets, histogram.cumulative_counts()
+                ):
+                    le = format_bound(bound)
+                    lines.append(f'{metric}_bucket{{{label},le="{le}"}} {count}')
+                lines.append(f"{metric}_sum{{{label}}} {histogram.sum}")
+                lines.append(f"{metric}_count{{{label}}} {histogram.count}")
+
+        metric = f"{self.prefix}_errors_total"
+        lines.append(f"# HELP {metric} Crud operations that raised an exception.")
+        lines.append(f"# TYPE {metric} counter")
+        for labels, count in self.errors.items():
+            label = 'operation="{}",schema="{}"'.format(*labels)
+            lines.append(f"{metric}{{{label}}} {count}")
+
+        return "\n".join(lines) + "\n"
+
+
+class SpanSink(Sink):
+    """操作毎にOpenTelemetryのトレーサー（start_spanを持つオブジェクト）でスパンを記録する"""
+
+    def __init__(self, tracer):
+        self.tracer = tracer
+
+    def record(self, operation: Operation):
+        span = self.tracer.start_span(
+            f"{operation.schema}.{operation.name}",
+            start_time=operation.start_time,
+            attributes={
+                "db.operation": operation.name,
+                "sqlalchemy14.schema": operation.schema,
+                "sqlalchemy14.db_time": operation.db_time,
+                "sqlalchemy14.conversion_time": operation.conversion_time,
+                "sqlalchemy14.rows": operation.rows,
+                "sqlalchemy14.round_trips": operation.round_trips,
+                "sqlalchemy14.statements": tuple(operation.statements),
+            },
+        )
+        if operation.error is not None:
+            span.record_exception(operation.error)
+        span.end(end_time=operation.start_time + int(operation.duration * 1e9))
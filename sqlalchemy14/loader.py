@@ -0,0 +1,52 @@
+import asyncio
+from typing import TYPE_CHECKING, List, Tuple
+
+if TYPE_CHECKING:
+    from .builder import DynamimcAsyncCrud
+
+
+class KeyLoader:
+    """同じイベントループのtick内で要求されたキーをまとめ、１つのクエリで取得する。
+
+    ローダーはセッションとスキーマ毎に作成され、セッションのinfoに保持される。
+    """
+
+    def __init__(self, crud: "DynamimcAsyncCrud"):
+        self.crud = crud
+        self.pending: List[Tuple[dict, asyncio.Future]] = []
+        # セッションは同時に複数のクエリを実行できないので、取得を直列化する
+        self.lock = asyncio.Lock()
+
+    @classmethod
+    def get(cls, crud: "DynamimcAsyncCrud") -> "KeyLoader":
+        loaders = crud.db.info.setdefault("sqlalchemy14.loaders", {})
+        loader = loaders.get(crud.__schema__)
+        if loader is None:
+            loader = loaders[crud.__schema__] = cls(crud)
+        return loader
+
+    def load(self, keys: dict) -> asyncio.Future:
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        if not self.pending:
+            # 現在のtickで実行待ちのタスクが全てキーを登録した後に取得を開始する
+            loop.call_soon(self.dispatch)
+        self.pending.append((keys, future))
+        return future
+
+    def dispatch(self):
+        pending, self.pending = self.pending, []
+        asyncio.ensure_future(self.fetch(pending))
+
+    async def fetch(self, pending: List[Tuple[dict, asyncio.Future]]):
+        try:
+            async with self.lock:
+                result = await self.crud._get_by_keys([keys for keys, f in pending])
+        except Exception as e:
+            for keys, future in pending:
+                if not future.done():
+                    future.set_exception(e)
+        else:
+            for (keys, future), obj in zip(pending, result):
+                if not future.done():
+                    future.set_result(obj)
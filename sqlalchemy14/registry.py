@@ -0,0 +1,63 @@
+from functools import lru_cache
+from typing import Callable, Dict, List, NamedTuple
+
+# スキーマ毎にキャッシュするステートメントなどの最大数。登録されたスキーマ数より大きくしてください
+SCHEMA_CACHE_MAXSIZE = 4096
+
+# Crudを継承した全てのスキーマ
+schemas: List[type] = []
+
+# cachedで生成された全てのキャッシュ
+caches: List[Callable] = []
+
+
+class CacheInfo(NamedTuple):
+    hits: int
+    misses: int
+    maxsize: int
+    currsize: int
+
+
+def cached(maxsize: int = SCHEMA_CACHE_MAXSIZE):
+    """lru_cacheと同様だが、統計の取得や無効化を行えるようレジストリに登録する"""
+
+    def decorator(func):
+        func = lru_cache(maxsize=maxsize)(func)
+        caches.append(func)
+        return func
+
+    return decorator
+
+
+def register(cls):
+    if cls not in schemas:
+        schemas.append(cls)
+
+
+def get_cache_name(func) -> str:
+    return f"{func.__module__}.{func.__qualname__}"
+
+
+def cache_info() -> Dict[str, CacheInfo]:
+    """キャッシュ毎のヒット数・ミス数・サイズを返す"""
+    return {get_cache_name(x): CacheInfo(*x.cache_info()) for x in caches}
+
+
+def cache_stats() -> CacheInfo:
+    """全てのキャッシュのヒット数・ミス数・サイズを合計して返す"""
+    infos = [x.cache_info() for x in caches]
+    return CacheInfo(
+        hits=sum(x.hits for x in infos),
+        misses=sum(x.misses for x in infos),
+        maxsize=sum(x.maxsize or 0 for x in infos),
+        currsize=sum(x.currsize for x in infos),
+    )
+
+
+def invalidate():
+    """解析結果・ステートメント・変換関数のキャッシュを全て破棄する。
+
+    マッパーを再構成した場合などに利用する。エンジンのコンパイル済みキャッシュは破棄しない
+    """
+    for x in caches:
+        x.cache_clear()
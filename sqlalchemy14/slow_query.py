@@ -0,0 +1,160 @@
+import asyncio
+import contextvars
+import random
+from collections import deque
+from dataclasses import asdict, dataclass
+from time import perf_counter, time
+from typing import Any, Callable, Dict, List, Optional, Set
+
+import sqlalchemy as sa
+from sqlalchemy.ext.asyncio import AsyncEngine
+
+from .explain import get_plan
+from .instrument import Operation, Sink, add_sink, current, remove_sink
+
+IGNORE_OPTION = "sqlalchemy14_slow_query_ignore"
+
+
+def redact_parameters(parameters):
+    """パラメータの値を型名に置き換える。構造（キーや個数）は残す"""
+    if isinstance(parameters, dict):
+        return {k: redact_parameters(v) for k, v in parameters.items()}
+    elif isinstance(parameters, (list, tuple)):
+        return [redact_parameters(x) for x in parameters]
+    elif parameters is None:
+        return None
+    else:
+        return f"<{type(parameters).__name__}>"
+
+
+@dataclass
+class SlowQuery:
+    statement: str
+    parameters: Any
+    duration: float
+    # 記録した時刻（エポック秒）
+    timestamp: float
+    executemany: bool = False
+    # 発行元のスキーマとCrudのメソッド。Crudを経由しない場合はNone
+    schema: Optional[str] = None
+    operation: Optional[str] = None
+    # EXPLAIN (FORMAT JSON)の最上位のプラン。サンプリングされなかった場合はNone
+    plan: Optional[dict] = None
+    explain_error: Optional[str] = None
+
+
+class SlowQueryRecorder(Sink):
+    """閾値（秒）を超えた文を直近maxlen件まで記録する。
+
+    explain_sample_rateの割合で、別の接続でEXPLAIN (FORMAT JSON)を取得する（PostgreSQLのみ）。
+    発行元のCrudを特定するため、記録中はCrudの計測を有効にする
+    """
+
+    def __init__(
+        self,
+        threshold: float = 0.1,
+        *,
+        maxlen: int = 1000,
+        explain_sample_rate: float = 0.1,
+        max_pending_explains: int = 4,
+        redact: Callable[[Any], Any] = redact_parameters,
+    ):
+        self.threshold = threshold
+        self.records: deque = deque(maxlen=maxlen)
+        self.explain_sample_rate = explain_sample_rate
+        self.max_pending_explains = max_pending_explains
+        self.redact = redact
+        self.engines: Dict[sa.engine.Engine, AsyncEngine] = {}
+        self.pending: Set[asyncio.Task] = set()
+
+    def record(self, operation: Operation):
+        pass
+
+    def attach(self, engine: AsyncEngine):
+        """エンジンで実行される文の記録を開始する。複数のエンジンに取り付けられる"""
+        sync_engine = engine.sync_engine
+        if sync_engine in self.engines:
+            return
+        if not self.engines:
+            add_sink(self)
+        self.engines[sync_engine] = engine
+        sa.event.listen(sync_engine, "before_cursor_execute", self.before_execute)
+        sa.event.listen(sync_engine, "after_cursor_execute", self.after_execute)
+
+    def detach(self, engine: AsyncEngine = None):
+        engines = list(self.engines.values()) if engine is None else [engine]
+        for x in engines:
+            sync_engine = x.sync_engine
+            sa.event.remove(sync_engine, "before_cursor_execute", self.before_execute)
+            sa.event.remove(sync_engine, "after_cursor_execute", self.after_execute)
+            del self.engines[sync_engine]
+        if not self.engines:
+            remove_sink(self)
+
+    def before_execute(self, conn, cursor, statement, parameters, context, many):
+        context._sqlalchemy14_start = perf_counter()
+
+    def after_execute(self, conn, cursor, statement, parameters, context, many):
+        if context.execution_options.get(IGNORE_OPTION):
+            return
+        duration = perf_counter() - context._sqlalchemy14_start
+        if duration < self.threshold:
+            return
+
+        operation = current.get()
+        record = SlowQuery(
+            statement=statement,
+            parameters=self.redact(parameters),
+            duration=duration,
+            timestamp=time(),
+            executemany=many,
+            schema=None if operation is None else operation.schema,
+            operation=None if operation is None else operation.name,
+        )
+        self.records.append(record)
+
+        if self.should_explain(conn, many):
+            self.schedule_explain(conn.engine, record, statement, parameters)
+
+    def should_explain(self, conn, many: bool) -> bool:
+        if many or conn.dialect.name != "postgresql":
+            return False
+        elif conn.engine not in self.engines:
+            return False
+        elif len(self.pending) >= self.max_pending_explains:
+            return False
+        return random.random() < self.explain_sample_rate
+
+    def schedule_explain(self, engine, record: SlowQuery, statement: str, parameters):
+        loop = asyncio.get_running_loop()
+        coro = self.explain(self.engines[engine], record, statement, parameters)
+        # 実行中の操作の計測に含めないよう、空のコンテキストでタスクを作成する
+        task = contextvars.Context().run(loop.create_task, coro)
+        self.pending.add(task)
+        task.add_done_callback(self.pending.discard)
+
+    async def explain(
+        self, engine: AsyncEngine, record: SlowQuery, statement: str, parameters
+    ):
+        try:
+            async with engine.connect() as conn:
+                conn = await conn.execution_options(**{IGNORE_OPTION: True})
+                if isinstance(parameters, list):
+                    parameters = tuple(parameters)
+                cur = await conn.exec_driver_sql(
+                    "EXPLAIN (FORMAT JSON) " + statement, parameters
+                )
+                record.plan = get_plan(cur.scalar_one())
+        except Exception as e:
+            record.explain_error = repr(e)
+
+    async def wait(self):
+        """実行中のEXPLAINの完了を待つ"""
+        if self.pending:
+            await asyncio.gather(*self.pending, return_exceptions=True)
+
+    def dump(self) -> List[dict]:
+        return [asdict(x) for x in self.records]
+
+    def clear(self):
+        self.records.clear()
@@ -1,4 +1,5 @@
 from inspect import isclass
+from typing import Sequence
 
 from .analyzer import (
     get_delete,
@@ -18,9 +19,23 @@ class Sql:
     def insert(self, **values):
         return get_insert(self.cls).values(**values)
 
-    def upsert(self, **values):
-        """挿入または更新を行います。衝突はプライマリキーのみ許可します。（単なるユニークキーは許可しません）"""
-        return get_upsert(self.cls).values(**values)
+    def upsert(
+        self,
+        *,
+        index_elements: Sequence[str] = None,
+        constraint: str = None,
+        dialect_name: str = "postgresql",
+        **values,
+    ):
+        """挿入または更新を行います。衝突対象を指定しない場合はプライマリキーで衝突を判定します。"""
+        stmt = get_upsert(
+            self.cls,
+            frozenset(values),
+            index_elements=None if index_elements is None else tuple(index_elements),
+            constraint=constraint,
+            dialect_name=dialect_name,
+        )
+        return stmt.values(**values)
 
     def update(self, **values):
         return get_update(self.cls).values(**values)
@@ -34,8 +49,25 @@ class Sql:
     def delete(self):
         return get_delete(self.cls)
 
-    def insert_many(cls):
-        raise NotImplementedError()
+    def insert_many(self, rows):
+        """複数行を１つのinsertで挿入します。各行のカラム構成は揃えてください"""
+        return get_insert(self.cls).values(list(rows))
 
-    def upsert_many(cls):
-        raise NotImplementedError()
+    def upsert_many(
+        self,
+        rows,
+        *,
+        index_elements: Sequence[str] = None,
+        constraint: str = None,
+        dialect_name: str = "postgresql",
+    ):
+        """複数行の挿入または更新を１つのinsertで行います。各行のカラム構成は揃えてください"""
+        rows = list(rows)
+        stmt = get_upsert(
+            self.cls,
+            frozenset(rows[0]),
+            index_elements=None if index_elements is None else tuple(index_elements),
+            constraint=constraint,
+            dialect_name=dialect_name,
+        )
+        return stmt.values(rows)
@@ -0,0 +1,54 @@
+from sqlalchemy.orm import Session
+
+
+def run(coro):
+    """イベントループを使わずにコルーチンを実行する。
+
+    SessionAdapterを通じた実行は中断しないので、コルーチンは１回のsendで完了する
+    """
+    try:
+        coro.send(None)
+    except StopIteration as e:
+        return e.value
+    coro.close()
+    raise RuntimeError("Coroutine suspended. Sync crud can not await real I/O.")
+
+
+class SessionAdapter:
+    """同期セッションをAsyncSessionと同じインターフェースで扱う。awaitは中断せずに完了する"""
+
+    def __init__(self, session: Session):
+        self.sync_session = session
+
+    def __getattr__(self, name):
+        return getattr(self.sync_session, name)
+
+    async def execute(self, statement, params=None, **kwargs):
+        return self.sync_session.execute(statement, params, **kwargs)
+
+    async def flush(self, objects=None):
+        self.sync_session.flush(objects)
+
+    async def stream(self, statement, params=None, execution_options=None, **kwargs):
+        execution_options = {**(execution_options or {}), "stream_results": True}
+        result = self.sync_session.execute(
+            statement, params, execution_options=execution_options, **kwargs
+        )
+        return ResultAdapter(result)
+
+
+class ResultAdapter:
+    """同期のResultをAsyncResultと同じインターフェースで扱う"""
+
+    def __init__(self, result):
+        self.result = result
+
+    def scalars(self):
+        return ResultAdapter(self.result.scalars())
+
+    async def partitions(self, size=None):
+        for partition in self.result.partitions(size):
+            yield partition
+
+    async def close(self):
+        self.result.close()
@@ -0,0 +1,175 @@
+import asyncio
+from itertools import groupby
+from typing import Any, Callable, List, Optional, Tuple
+
+from pydantic import BaseModel
+
+from .analyzer import get_conflict_target, to_column_values
+
+# 書き込みを終了するためにキューへ入れる目印
+CLOSE = object()
+
+
+class BatchWriter:
+    """スキーマのcreate・upsertをバッファし、複数行を１つの文でまとめて書き込む。
+
+    バッファがmax_batch_size件に達するか、最初の要求からmax_latency秒経過すると書き込む。
+    書き込みはバッチ毎に新しいセッションで行いコミットする。
+    同じキーへのupsertは１つの文で書き込めないので、キーが重複する要求から別の文に分ける。
+    max_pending件を超えて要求が溜まっている場合、要求は空きができるまで待機する。
+    """
+
+    def __init__(
+        self,
+        schema,
+        create_session: Callable,
+        *,
+        max_batch_size: int = 500,
+        max_latency: float = 0.005,
+        max_pending: int = 10000,
+        index_elements: List[str] = None,
+        constraint: str = None,
+    ):
+        self.schema = schema
+        self.create_session = create_session
+        self.max_batch_size = max_batch_size
+        self.max_latency = max_latency
+        self.max_pending = max_pending
+        self.index_elements = index_elements
+        self.constraint = constraint
+        # 衝突対象が誤っていれば、要求を受け付ける前にKeyErrorを送出する
+        self.target = get_conflict_target(
+            schema,
+            None if index_elements is None else tuple(index_elements),
+            constraint,
+        )
+        self.queue: Optional[asyncio.Queue] = None
+        self.task: Optional[asyncio.Task] = None
+        self.closed = False
+        self.batches = 0
+
+    async def __aenter__(self):
+        self.start()
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.close()
+
+    def start(self):
+        if self.task is None:
+            self.queue = asyncio.Queue(self.max_pending)
+            self.task = asyncio.create_task(self.run())
+
+    async def close(self):
+        """バッファに残った要求を全て書き込んでから終了する"""
+        if self.closed:
+            return
+        self.closed = True
+        if self.task is not None:
+            await self.queue.put(CLOSE)
+            await self.task
+
+    async def create(self, obj: BaseModel = None, /, **kwargs):
+        """行を挿入し、挿入した行をスキーマに変換して返します"""
+        return await self.submit("create", obj, kwargs)
+
+    async def upsert(self, obj: BaseModel = None, /, **kwargs):
+        """行を挿入または更新し、その行をスキーマに変換して返します"""
+        return await self.submit("upsert", obj, kwargs)
+
+    async def submit(self, operation: str, obj, kwargs):
+        if obj:
+            assert not kwargs
+            kwargs = obj.dict()
+        if self.closed:
+            raise RuntimeError("BatchWriter is closed.")
+        if self.task is not None and self.task.done():
+            raise RuntimeError("BatchWriter is stopped.")
+
+        self.start()
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put((operation, kwargs, future))
+        return await future
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        closing = False
+
+        while not closing:
+            item = await self.queue.get()
+            if item is CLOSE:
+                break
+
+            batch = [item]
+            deadline = loop.time() + self.max_latency
+            while len(batch) < self.max_batch_size:
+                try:
+                    item = self.queue.get_nowait()
+                except asyncio.QueueEmpty:
+                    timeout = deadline - loop.time()
+                    if timeout <= 0:
+                        break
+                    try:
+                        item = await asyncio.wait_for(self.queue.get(), timeout)
+                    except asyncio.TimeoutError:
+                        break
+
+                if item is CLOSE:
+                    closing = True
+                    break
+                batch.append(item)
+
+            await self.flush(batch)
+
+    def split(self, batch: List[Tuple[str, dict, asyncio.Future]]):
+        """要求の順序を保ったまま、同じ操作の連続した要求をまとめる。
+
+        upsertは衝突対象のキーが重複するとpostgresqlではエラーになるので、重複する要求の前で分ける
+        """
+        groups = []
+        for operation, items in groupby(batch, key=lambda x: x[0]):
+            group: list = []
+            seen: set = set()
+            for item in items:
+                if operation == "upsert":
+                    values = to_column_values(self.schema, item[1])
+                    key = tuple(values.get(x) for x in self.target)
+                    # キーを指定しない行は採番されるので衝突しない
+                    if key in seen:
+                        groups.append((operation, group))
+                        group, seen = [], set()
+                    if None not in key:
+                        seen.add(key)
+                group.append(item)
+            groups.append((operation, group))
+
+        return groups
+
+    async def flush(self, batch: List[Tuple[str, dict, asyncio.Future]]):
+        """まとめた要求を１つのトランザクションで書き込む"""
+        self.batches += 1
+        results: List[Any] = []
+
+        try:
+            groups = self.split(batch)
+            async with self.create_session() as db:
+                crud = self.schema.crud(db)
+                for operation, items in groups:
+                    rows = [values for op, values, future in items]
+                    if operation == "create":
+                        results += await crud.create_many(rows)
+                    else:
+                        results += await crud.upsert_many(
+                            rows,
+                            index_elements=self.index_elements,
+                            constraint=self.constraint,
+                        )
+                await db.commit()
+        except Exception as e:
+            for op, values, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+        else:
+            for (op, values, future), obj in zip(batch, results):
+                if not future.done():
+                    future.set_result(obj)
@@ -0,0 +1,245 @@
+import asyncio
+from collections import OrderedDict
+
+import pytest
+import sqlalchemy as sa
+from pydantic import BaseModel
+
+from sqlalchemy14 import (
+    Crud,
+    MemoryBackend,
+    ResultCache,
+    SharedBackend,
+    add_sink,
+    create_engine,
+    create_sync_engine,
+    remove_sink,
+)
+from sqlalchemy14.instrument import Sink
+
+R = sa.orm.registry()
+Base = R.generate_base()
+
+
+class Countries(Base, Crud):
+    __tablename__ = "countries"
+    __cache__ = ResultCache(ttl=60)
+    id = sa.Column(sa.Integer, primary_key=True)
+    name = sa.Column(sa.String)
+
+
+class Country(BaseModel, Crud[Countries]):
+    __cache__ = ResultCache(SharedBackend(), ttl=60)
+
+    class Config:
+        orm_mode = True
+
+    id: int = None
+    name: str = None
+
+
+class CountryName(BaseModel, Crud[Countries]):
+    class Config:
+        orm_mode = True
+
+    name: str = None
+
+
+class SuspendingBackend(MemoryBackend):
+    """Redisなどのように実際にI/Oを待機するバックエンドの代わり"""
+
+    async def get(self, key: str):
+        await asyncio.sleep(0)
+        return await super().get(key)
+
+
+class SuspendingCountry(BaseModel, Crud[Countries]):
+    __cache__ = ResultCache(SuspendingBackend())
+
+    class Config:
+        orm_mode = True
+
+    id: int = None
+    name: str = None
+
+
+class ListSink(Sink):
+    def __init__(self):
+        self.operations = []
+
+    def record(self, operation):
+        self.operations.append(operation)
+
+
+@pytest.fixture
+async def db():
+    engine, create_session = create_engine("sqlite+aiosqlite://")
+    async with engine.begin() as conn:
+        await conn.run_sync(R.metadata.create_all)
+    async with create_session() as db:
+        yield db
+    await Countries.__cache__.invalidate(Countries)
+    await Country.__cache__.invalidate(Country)
+    await engine.dispose()
+
+
+@pytest.fixture
+async def create_session(tmp_path):
+    """複数のセッションで同じDBを参照するためにファイルのDBを使う"""
+    engine, create_session = create_engine(f"sqlite+aiosqlite:///{tmp_path}/cache.db")
+    async with engine.begin() as conn:
+        await conn.run_sync(R.metadata.create_all)
+    yield create_session
+    await Countries.__cache__.invalidate(Countries)
+    await Country.__cache__.invalidate(Country)
+    await engine.dispose()
+
+
+@pytest.mark.asyncio
+async def test_read_through(db):
+    cache = Country.crud.cache
+    hits, misses = cache.hits, cache.misses
+    created = await Countries.crud(db).create(name="japan")
+    await db.commit()
+
+    sink = ListSink()
+    add_sink(sink)
+    try:
+        first = await Country.crud(db).get(created.id)
+        second = await Country.crud(db).get(id=created.id)
+    finally:
+        remove_sink(sink)
+
+    assert first == second == Country(id=created.id, name="japan")
+    # 共有キャッシュの代わりのバックエンドは取得の度に新しいオブジェクトを返す
+    assert first is not second
+    assert (cache.hits - hits, cache.misses - misses) == (1, 1)
+    assert [x.round_trips for x in sink.operations] == [1, 0]
+
+    # 存在しないキーはキャッシュしない
+    assert await Country.crud(db).get_or_none(-1) is None
+    assert await Country.crud(db).get_or_none(-1) is None
+    assert cache.misses - misses == 3
+    assert CountryName.crud.cache is None
+
+
+@pytest.mark.asyncio
+async def test_invalidate(db):
+    created = await Countries.crud(db).create(name="japan")
+    await db.commit()
+    assert (await Country.crud(db).get(created.id)).name == "japan"
+    assert (await Countries.crud(db).get(created.id)).name == "japan"
+
+    # 同じエンティティの別のスキーマで更新してもエントリを破棄する
+    await CountryName.crud(db).update(id=created.id, name="nippon")
+    await db.commit()
+    assert (await Country.crud(db).get(created.id)).name == "nippon"
+    assert (await Countries.crud(db).get(created.id)).name == "nippon"
+
+    await Country.crud(db).upsert(id=created.id, name="upserted")
+    await db.commit()
+    assert (await Country.crud(db).get(created.id)).name == "upserted"
+
+    await Country.crud(db).upsert_many(
+        [{"id": 100, "name": "a"}, {"id": created.id, "name": "b"}]
+    )
+    await db.commit()
+    assert (await Countries.crud(db).get(created.id)).name == "b"
+
+    await Countries.crud(db).delete(id=created.id)
+    await db.commit()
+    assert await Country.crud(db).get_or_none(created.id) is None
+
+
+@pytest.mark.asyncio
+async def test_rollback(create_session):
+    async with create_session() as db:
+        created = await Countries.crud(db).create(name="orig")
+        await db.commit()
+
+    # コミットしていない書き込みはキャッシュせず、ロールバックした後に残らない
+    async with create_session() as db:
+        await Countries.crud(db).update(id=created.id, name="uncommitted")
+        assert (await Country.crud(db).get(created.id)).name == "uncommitted"
+        uncommitted = await Countries.crud(db).create(name="uncommitted")
+        assert await Country.crud(db).get_or_none(uncommitted.id) is not None
+        await db.rollback()
+        assert (await Country.crud(db).get(created.id)).name == "orig"
+
+    async with create_session() as db:
+        assert (await Country.crud(db).get(created.id)).name == "orig"
+        assert await Country.crud(db).get_or_none(uncommitted.id) is None
+
+
+@pytest.mark.asyncio
+async def test_concurrent_read(create_session):
+    async with create_session() as db:
+        created = await Countries.crud(db).create(name="old")
+        await db.commit()
+
+    # 書き込みからコミットまでの間に他のセッションがキャッシュした古い値は、コミットした後に破棄する
+    async with create_session() as writer, create_session() as reader:
+        await Countries.crud(writer).update(id=created.id, name="new")
+        assert (await Country.crud(reader).get(created.id)).name == "old"
+        assert (await Country.crud(reader).get(created.id)).name == "old"
+        await reader.commit()
+        await writer.commit()
+
+    async with create_session() as db:
+        assert (await Country.crud(db).get(created.id)).name == "new"
+
+
+def test_sync_crud():
+    engine, create_session = create_sync_engine("sqlite://")
+    R.metadata.create_all(engine)
+    cache = Country.crud.cache
+    try:
+        with create_session() as db:
+            created = Countries.crud_sync(db).create(name="a")
+            db.commit()
+            # 待機するバックエンドは同期のcrudでは使えない
+            with pytest.raises(RuntimeError):
+                SuspendingCountry.crud_sync(db).get(created.id)
+
+            hits = cache.hits
+            assert Country.crud_sync(db).get(created.id).name == "a"
+            assert Country.crud_sync(db).get(created.id).name == "a"
+            assert cache.hits - hits == 1
+
+            Countries.crud_sync(db).update(id=created.id, name="b")
+            assert Country.crud_sync(db).get(created.id).name == "b"
+    finally:
+        engine.dispose()
+        cache.backend.store.clear()
+        Countries.crud.cache.backend.store.clear()
+
+
+@pytest.mark.asyncio
+async def test_memory_backend():
+    backend = MemoryBackend(maxsize=2)
+    await backend.set("a", 1, ttl=60)
+    await backend.set("b", 2, ttl=60)
+    assert await backend.get("a") == 1
+    await backend.set("c", 3, ttl=60)
+    # 最も長く使われていないエントリから破棄する
+    assert list(backend.store) == ["a", "c"]
+
+    await backend.set("d", 4, ttl=0)
+    assert await backend.get("d") is None
+    assert "d" not in backend.store
+
+    await backend.clear("a")
+    assert list(backend.store) == ["c"]
+
+
+@pytest.mark.asyncio
+async def test_shared_backend():
+    store: OrderedDict = OrderedDict()
+    a = SharedBackend(store=store)
+    b = SharedBackend(store=store)
+    await a.set("key", {"name": "a"}, ttl=60)
+    assert await b.get("key") == {"name": "a"}
+    assert isinstance(store["key"][1], bytes)
+
+    await b.delete(["key"])
+    assert await a.get("key") is None
@@ -0,0 +1,109 @@
+from types import SimpleNamespace
+from typing import List, Optional
+
+import sqlalchemy as sa
+from pydantic import BaseModel, validator
+from sqlalchemy.orm import declarative_base, relationship
+
+from sqlalchemy14 import Crud
+from sqlalchemy14.converter import get_converter, get_row_converter
+
+Base = declarative_base()
+
+
+class ConverterParents(Base):
+    __tablename__ = "converter_parents"
+    id = sa.Column(sa.Integer, primary_key=True)
+    name = sa.Column(sa.String)
+    children = relationship("ConverterChildren")
+
+
+class ConverterChildren(Base):
+    __tablename__ = "converter_children"
+    id = sa.Column(sa.Integer, primary_key=True)
+    parent_id = sa.Column(sa.Integer, sa.ForeignKey("converter_parents.id"))
+
+
+class Child(BaseModel, Crud[ConverterChildren]):
+    class Config:
+        orm_mode = True
+
+    id: int
+
+
+class Parent(BaseModel, Crud[ConverterParents]):
+    class Config:
+        orm_mode = True
+
+    id: int
+    name: Optional[str]
+    children: List[Child]
+
+
+class ValidatedParent(BaseModel, Crud[ConverterParents]):
+    class Config:
+        orm_mode = True
+
+    id: int
+    name: str
+
+
+class TrustedParent(BaseModel, Crud[ConverterParents]):
+    __trusted__ = True
+
+    class Config:
+        orm_mode = True
+
+    id: int
+    name: str
+
+
+class ValidatorParent(BaseModel, Crud[ConverterParents]):
+    __trusted__ = True
+
+    class Config:
+        orm_mode = True
+
+    id: int
+    name: str
+
+    @validator("name")
+    def upper(cls, v):
+        return v.upper()
+
+
+def test_trusted_converter():
+    child = SimpleNamespace(id=2)
+    obj = SimpleNamespace(id=1, name="parent", children=[child])
+
+    parent = get_converter(Parent)(obj)
+    assert parent == Parent(id=1, name="parent", children=[Child(id=2)])
+    assert parent.__fields_set__ == {"id", "name", "children"}
+    assert isinstance(parent.children[0], Child)
+
+    # 信頼モードでは検証を行わない
+    assert (
+        get_converter(Parent)(SimpleNamespace(id="1", name=None, children=[])).id == "1"
+    )
+
+
+def test_validated_converter():
+    assert (
+        get_converter(Parent, False)(SimpleNamespace(id="1", name=None, children=[])).id
+        == 1
+    )
+    # 既定では検証を行い、信頼モードは明示した場合のみ
+    assert ValidatedParent.crud(None).output(SimpleNamespace(id="1", name="a")).id == 1
+    assert TrustedParent.crud(None).output(SimpleNamespace(id="1", name="a")).id == "1"
+
+    # バリデータを持つスキーマは信頼モードでも検証する
+    assert (
+        ValidatorParent.crud(None).output(SimpleNamespace(id=1, name="a")).name == "A"
+    )
+    assert get_row_converter(ValidatorParent, True)((1, "a")).name == "A"
+
+
+def test_row_converter():
+    assert get_row_converter(ValidatedParent)((1, "parent")) == ValidatedParent(
+        id=1, name="parent"
+    )
@@ -0,0 +1,107 @@
+import pytest
+import sqlalchemy as sa
+from pydantic import BaseModel
+from sqlalchemy.orm.exc import DetachedInstanceError
+
+from sqlalchemy14 import Crud, create_engine, create_sync_engine
+from sqlalchemy14.analyzer import get_deferred, get_insert, get_select_related
+
+R = sa.orm.registry()
+Base = R.generate_base()
+
+
+class Documents(Base, Crud):
+    __tablename__ = "documents"
+    __deferred__ = "auto"
+    id = sa.Column(sa.Integer, primary_key=True)
+    title = sa.Column(sa.String)
+    body = sa.Column(sa.Text)
+    data = sa.Column(sa.JSON)
+    image = sa.Column(sa.LargeBinary)
+
+
+class Notes(Base, Crud):
+    __tablename__ = "notes"
+    __deferred__ = ["body"]
+    id = sa.Column(sa.Integer, primary_key=True)
+    title = sa.Column(sa.String)
+    body = sa.Column(sa.String)
+    memo = sa.orm.deferred(sa.Column(sa.String))
+
+
+class Document(BaseModel, Crud[Documents]):
+    class Config:
+        orm_mode = True
+
+    id: int = None
+    title: str = None
+    body: str = None
+
+
+@pytest.fixture
+async def db():
+    engine, create_session = create_engine("sqlite+aiosqlite://")
+    async with engine.begin() as conn:
+        await conn.run_sync(R.metadata.create_all)
+    async with create_session() as db:
+        yield db
+    await engine.dispose()
+
+
+def test_policy():
+    assert get_deferred(Documents) == ("body", "data", "image")
+    assert set(get_deferred(Notes)) == {"body", "memo"}
+    # 明示的にカラムを指定したスキーマは遅延させない
+    assert get_deferred(Document) == ()
+
+    # fmt: off
+    assert str(get_insert(Documents)) == "INSERT INTO documents (id, title, body, data, image) VALUES (:id, :title, :body, :data, :image) RETURNING documents.id, documents.title"
+    assert str(get_select_related(Documents)) == "SELECT documents.id, documents.title \nFROM documents"
+    # fmt: on
+
+    # Crudを継承するとprepare_allの対象になるので、別のレジストリのORMモデルで確認する
+    class Unknown(sa.orm.registry().generate_base()):
+        __tablename__ = "unknown"
+        __deferred__ = ["missing"]
+        id = sa.Column(sa.Integer, primary_key=True)
+
+    with pytest.raises(ValueError):
+        get_deferred(Unknown)
+
+
+@pytest.mark.asyncio
+async def test_undefer(db):
+    created = await Documents.crud(db).create(
+        title="a", body="text", data={"a": 1}, image=b"\x00"
+    )
+    obj = await Documents.crud(db).get(created.id)
+    assert obj.title == "a"
+    with pytest.raises(DetachedInstanceError):
+        obj.body
+
+    assert await Documents.crud(db).undefer(obj) is obj
+    assert (obj.body, obj.data, obj.image) == ("text", {"a": 1}, b"\x00")
+
+    objects = await Documents.crud(db).all()
+    await Documents.crud(db).undefer_many(objects, "body")
+    assert [x.body for x in objects] == ["text"]
+
+    # スキーマが必要とするカラムは遅延させない
+    assert (await Document.crud(db).get(created.id)).body == "text"
+
+    await Documents.crud(db).delete(id=created.id)
+    with pytest.raises(KeyError):
+        await Documents.crud(db).undefer(obj)
+
+
+def test_sync_undefer():
+    engine, create_session = create_sync_engine("sqlite://")
+    R.metadata.create_all(engine)
+    with create_session() as db:
+        created = Notes.crud_sync(db).create(title="a", body="b", memo="c")
+        obj = Notes.crud_sync(db).get(created.id)
+        Notes.crud_sync(db).undefer(obj, "memo")
+        assert obj.memo == "c"
+        with pytest.raises(DetachedInstanceError):
+            obj.body
+    engine.dispose()
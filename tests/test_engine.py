@@ -0,0 +1,278 @@
+import os
+import re
+
+import pytest
+import sqlalchemy as sa
+
+from sqlalchemy14 import (
+    Crud,
+    DriverConfig,
+    PoolConfig,
+    SlowQueryRecorder,
+    create_engine,
+    create_routing_engine,
+    get_pool_metrics,
+)
+
+
+def get_connection_string():
+    host = os.getenv("POSTGRES_HOST", "127.0.0.1")
+    db = os.getenv("POSTGRES_DB", "postgres")
+    user = os.getenv("POSTGRES_USER", "postgres")
+    pw = os.getenv("POSTGRES_PASSWORD", "postgres")
+    port = os.getenv("POSTGRES_PORT", "5432")
+    return f"postgresql+asyncpg://{user}:{pw}@{host}:{port}/{db}"
+
+
+def test_pool_config():
+    engine, create_session = create_engine(
+        get_connection_string(),
+        pool_config=PoolConfig(
+            pool_size=3, max_overflow=1, pool_recycle=60, pool_pre_ping=True
+        ),
+        driver_config=DriverConfig(prepared_statement_cache_size=10),
+    )
+    pool = engine.sync_engine.pool
+    assert isinstance(pool, sa.pool.AsyncAdaptedQueuePool)
+    assert pool.size() == 3
+    assert pool._max_overflow == 1
+    assert pool._recycle == 60
+    assert pool._pre_ping
+    assert engine.url.query["prepared_statement_cache_size"] == "10"
+
+    metrics = get_pool_metrics(engine)
+    assert metrics.size == 3
+    assert metrics.checked_out == 0
+
+
+def test_driver_config():
+    config = DriverConfig(pgbouncer=True, connect_args={"timeout": 5})
+    connect_args = config.get_connect_args()
+    assert connect_args["statement_cache_size"] == 0
+    assert connect_args["timeout"] == 5
+
+    engine, create_session = create_engine(
+        get_connection_string(), driver_config=config
+    )
+    assert engine.url.query["prepared_statement_cache_size"] == "0"
+
+    with pytest.raises(ValueError):
+        create_engine("sqlite+aiosqlite://", driver_config=config)
+
+
+@pytest.mark.asyncio
+async def test_pool_metrics():
+    engine, create_session = create_engine("sqlite+aiosqlite://")
+    metrics = get_pool_metrics(engine)
+    try:
+        async with create_session() as db:
+            assert (await db.execute(sa.text("select 1"))).scalar() == 1
+        async with engine.connect() as conn:
+            await conn.execute(sa.text("select 1"))
+    finally:
+        await engine.dispose()
+
+    snapshot = metrics.snapshot()
+    assert snapshot["checkouts"] == 2
+    assert snapshot["connects"] == 1
+    assert snapshot["connect_time"] > 0
+    assert snapshot["wait_time"] >= snapshot["max_wait_time"] > 0
+    assert snapshot["timeouts"] == 0
+
+    # disposeで再作成されたプールも計測される
+    assert metrics.pool is engine.sync_engine.pool
+
+
+@pytest.mark.docker
+@pytest.mark.asyncio
+async def test_pool_exhaustion():
+    engine, create_session = create_engine(
+        get_connection_string(),
+        pool_config=PoolConfig(pool_size=1, max_overflow=0, pool_timeout=0.1),
+    )
+    metrics = get_pool_metrics(engine)
+    try:
+        async with engine.connect() as conn:
+            await conn.execute(sa.text("select 1"))
+            assert metrics.checked_out == 1
+            with pytest.raises(sa.exc.TimeoutError):
+                async with engine.connect():
+                    pass
+    finally:
+        await engine.dispose()
+
+    assert metrics.timeouts == 1
+    assert metrics.checkouts == 2
+    assert metrics.max_wait_time >= 0.1
+
+
+@pytest.mark.docker
+@pytest.mark.asyncio
+async def test_pgbouncer_mode():
+    engine, create_session = create_engine(
+        get_connection_string(), driver_config=DriverConfig(pgbouncer=True)
+    )
+    try:
+        async with create_session() as db:
+            assert (await db.execute(sa.text("select 1"))).scalar() == 1
+            conn = await db.connection()
+            raw = conn.sync_connection.connection.connection._connection
+            name = raw._get_unique_id("stmt")
+            names = (
+                await db.execute(sa.text("select name from pg_prepared_statements"))
+            ).scalars()
+            names = list(names)
+    finally:
+        await engine.dispose()
+
+    # 連番ではなくuuidで名付けられ、接続にステートメントが残らない
+    assert re.fullmatch(r"__asyncpg_stmt_[0-9a-f]{32}__", name)
+    assert all(re.fullmatch(r"__asyncpg_stmt_[0-9a-f]{32}__", x) for x in names)
+
+
+R = sa.orm.registry()
+Base = R.generate_base()
+
+
+class Nodes(Base, Crud):
+    __tablename__ = "nodes"
+    id = sa.Column(sa.Integer, primary_key=True)
+    name = sa.Column(sa.String)
+
+
+async def create_routing_session(**kwargs):
+    router, create_session = create_routing_engine(
+        "sqlite+aiosqlite://", ["sqlite+aiosqlite://"], **kwargs
+    )
+    # プライマリとレプリカは別々のインメモリDBなので、どちらから読み取ったか判別できる
+    for engine, name in [(router.primary, "primary"), *zip(router.replicas, ["r"])]:
+        async with engine.begin() as conn:
+            await conn.run_sync(R.metadata.create_all)
+            await conn.execute(sa.insert(Nodes.__table__).values(name=name))
+    return router, create_session
+
+
+async def get_names(db):
+    return [x.name for x in await Nodes.crud(db).all()]
+
+
+@pytest.mark.asyncio
+async def test_routing():
+    router, create_session = await create_routing_session()
+    try:
+        async with create_session() as db:
+            assert await get_names(db) == ["r"]
+            assert await Nodes.crud(db).exist(id=1)
+
+            await Nodes.crud(db).create(name="created")
+            assert await get_names(db) == ["primary", "created"]
+            await db.commit()
+
+            assert await get_names(db) == ["r"]
+
+        async with create_session() as db:
+            async with db.begin():
+                assert await get_names(db) == ["primary", "created"]
+            assert await get_names(db) == ["r"]
+    finally:
+        await router.dispose()
+
+
+@pytest.mark.asyncio
+async def test_routing_read_your_writes():
+    router, create_session = await create_routing_session(read_your_writes=True)
+    try:
+        async with create_session() as db:
+            assert await get_names(db) == ["r"]
+            await Nodes.crud(db).create(name="created")
+            await db.commit()
+            assert await get_names(db) == ["primary", "created"]
+    finally:
+        await router.dispose()
+
+
+@pytest.mark.asyncio
+async def test_replica_strategy():
+    replicas = ["sqlite+aiosqlite://"] * 2
+    router, create_session = create_routing_engine("sqlite+aiosqlite://", replicas)
+    assert [router.get_replica() for i in range(3)] == [
+        router.replicas[0],
+        router.replicas[1],
+        router.replicas[0],
+    ]
+
+    router, create_session = create_routing_engine(
+        "sqlite+aiosqlite://",
+        replicas,
+        strategy="least_connections",
+        poolclass=sa.pool.AsyncAdaptedQueuePool,
+    )
+    try:
+        assert router.get_replica() is router.replicas[0]
+        async with router.replicas[0].connect():
+            assert router.get_replica() is router.replicas[1]
+    finally:
+        await router.dispose()
+
+    with pytest.raises(ValueError):
+        create_routing_engine("sqlite+aiosqlite://", [], strategy="random")
+
+
+@pytest.mark.asyncio
+async def test_slow_query():
+    recorder = SlowQueryRecorder(threshold=0, maxlen=3, explain_sample_rate=1)
+    engine, create_session = create_engine("sqlite+aiosqlite://", slow_query=recorder)
+    try:
+        async with engine.begin() as conn:
+            await conn.run_sync(R.metadata.create_all)
+        recorder.clear()
+
+        async with create_session() as db:
+            await Nodes.crud(db).create(name="secret")
+            await Nodes.crud(db).get(1)
+            await db.execute(sa.text("select 1"))
+        await recorder.wait()
+    finally:
+        recorder.detach()
+        await engine.dispose()
+
+    # 直近の３件のみ保持する
+    select, get, text = recorder.dump()
+    assert select["operation"] == "create"
+    assert get["schema"] == "Nodes"
+    assert get["operation"] == "get"
+    assert get["parameters"] == ["<int>"]
+    assert text["operation"] is None
+    assert "secret" not in str(recorder.dump())
+
+    # sqliteではEXPLAINを取得しない
+    assert get["plan"] is None
+
+
+@pytest.mark.docker
+@pytest.mark.asyncio
+async def test_slow_query_explain():
+    recorder = SlowQueryRecorder(threshold=0, explain_sample_rate=1)
+    engine, create_session = create_engine(get_connection_string())
+    try:
+        async with engine.begin() as conn:
+            await conn.run_sync(R.metadata.drop_all)
+            await conn.run_sync(R.metadata.create_all)
+
+        recorder.attach(engine)
+        async with create_session() as db:
+            await Nodes.crud(db).get_or_none(1)
+        await recorder.wait()
+        recorder.detach()
+
+        async with engine.begin() as conn:
+            await conn.run_sync(R.metadata.drop_all)
+    finally:
+        await engine.dispose()
+
+    get = [x for x in recorder.records if x.operation == "get_or_none"][0]
+    assert get.schema == "Nodes"
+    assert get.parameters == ["<int>"]
+    assert get.explain_error is None
+    assert get.plan["Relation Name"] == "nodes"
+    assert all(x.operation is not None for x in recorder.records)
@@ -0,0 +1,180 @@
+import pytest
+import sqlalchemy as sa
+from pydantic import BaseModel
+
+from sqlalchemy14 import (
+    Crud,
+    HistogramSink,
+    SpanSink,
+    add_sink,
+    create_engine,
+    remove_sink,
+)
+from sqlalchemy14.instrument import Sink, count_round_trip, sinks
+
+R = sa.orm.registry()
+Base = R.generate_base()
+
+
+class Users(Base, Crud):
+    __tablename__ = "users"
+    id = sa.Column(sa.Integer, primary_key=True)
+    name = sa.Column(sa.String)
+
+
+class User(BaseModel, Crud[Users]):
+    class Config:
+        orm_mode = True
+
+    id: int = None
+    name: str = None
+
+
+class ListSink(Sink):
+    def __init__(self):
+        self.operations = []
+
+    def record(self, operation):
+        self.operations.append(operation)
+
+
+class Span:
+    def __init__(self, name, start_time, attributes):
+        self.name = name
+        self.start_time = start_time
+        self.attributes = attributes
+        self.exceptions = []
+        self.end_time = None
+
+    def record_exception(self, exception):
+        self.exceptions.append(exception)
+
+    def end(self, end_time=None):
+        self.end_time = end_time
+
+
+class Tracer:
+    def __init__(self):
+        self.spans = []
+
+    def start_span(self, name, start_time=None, attributes=None):
+        span = Span(name, start_time, attributes)
+        self.spans.append(span)
+        return span
+
+
+@pytest.fixture
+async def db():
+    engine, create_session = create_engine("sqlite+aiosqlite://")
+    async with engine.begin() as conn:
+        await conn.run_sync(R.metadata.create_all)
+    async with create_session() as db:
+        yield db
+    await engine.dispose()
+
+
+@pytest.fixture
+def sink():
+    sink = ListSink()
+    add_sink(sink)
+    yield sink
+    remove_sink(sink)
+
+
+@pytest.mark.asyncio
+async def test_no_sink(db):
+    crud = User.crud(db)
+    await crud.create(name="a")
+    assert await crud.all()
+
+    assert not sinks
+    assert "output" not in crud.__dict__
+    assert not sa.event.contains(
+        sa.engine.Engine, "before_cursor_execute", count_round_trip
+    )
+
+
+@pytest.mark.asyncio
+async def test_operation(db, sink):
+    created = await User.crud(db).create(name="a")
+    await User.crud(db).create(name="b")
+    await User.crud(db).update(id=created.id, name="c")
+    users = await User.crud(db).all()
+    with pytest.raises(KeyError):
+        await User.crud(db).get(-1)
+
+    create, _, update, all, get = sink.operations
+    assert [x.name for x in sink.operations] == [
+        "create",
+        "create",
+        "update",
+        "all",
+        "get",
+    ]
+    assert all.schema == "User"
+
+    # returningが使えないsqliteではフラッシュした後に取得し直す
+    assert create.statements == ["insert", "select"]
+    assert create.rows == 1
+    # update_or_passなどネストした呼び出しは１つの操作に計上する
+    assert update.statements == ["select", "update", "select"]
+    assert update.round_trips == 3
+    assert all.rows == len(users) == 2
+    assert all.duration >= all.db_time > 0
+    assert all.conversion_time > 0
+    assert isinstance(get.error, KeyError)
+
+
+@pytest.mark.asyncio
+async def test_stream(db, sink):
+    await User.crud(db).create_many([{"name": str(i)} for i in range(5)])
+    names = []
+    async for x in User.crud(db).stream(chunk_size=2):
+        # 呼び出し側の処理は別の操作として計上する
+        names.append((await User.crud(db).get(x.id)).name)
+
+    stream = sink.operations[-1]
+    assert stream.name == "stream"
+    assert stream.rows == 5
+    assert [x.name for x in sink.operations[1:-1]] == ["get"] * 5
+    assert sorted(names) == [str(i) for i in range(5)]
+
+
+@pytest.mark.asyncio
+async def test_histogram_sink(db):
+    sink = HistogramSink()
+    add_sink(sink)
+    try:
+        await User.crud(db).create(name="a")
+        await User.crud(db).all()
+        await User.crud(db).all()
+    finally:
+        remove_sink(sink)
+
+    text = sink.render()
+    label = 'operation="all",schema="User"'
+    assert "# TYPE sqlalchemy14_operation_duration_seconds histogram" in text
+    assert (
+        f'sqlalchemy14_operation_duration_seconds_bucket{{{label},le="+Inf"}} 2' in text
+    )
+    assert f"sqlalchemy14_operation_round_trips_count{{{label}}} 2" in text
+    assert f'sqlalchemy14_operation_rows_bucket{{{label},le="1.0"}} 2' in text
+
+
+@pytest.mark.asyncio
+async def test_span_sink(db):
+    tracer = Tracer()
+    sink = SpanSink(tracer)
+    add_sink(sink)
+    try:
+        await User.crud(db).create(name="a")
+        with pytest.raises(KeyError):
+            await User.crud(db).delete(id=-1)
+    finally:
+        remove_sink(sink)
+
+    create, delete = tracer.spans
+    assert create.name == "User.create"
+    assert create.attributes["sqlalchemy14.round_trips"] == 2
+    assert create.end_time >= create.start_time
+    assert isinstance(delete.exceptions[0], KeyError)
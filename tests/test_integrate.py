@@ -1,3 +1,4 @@
+import asyncio
 import os
 
 import pytest
@@ -6,7 +7,7 @@ from pydantic import BaseModel
 from sqlalchemy import delete
 from sqlalchemy.orm import relationship
 
-from sqlalchemy14 import Crud
+from sqlalchemy14 import BatchWriter, Crud, registry
 
 R = sa.orm.registry()
 Base = R.generate_base()
@@ -19,6 +20,13 @@ class Persons(Base, Crud):
 
 
 class Person(BaseModel, Crud[Persons]):
+    __queries__ = {
+        "by_name": lambda stmt, name: stmt.where(Persons.name == name),
+        "page": lambda stmt, limit, offset: (
+            stmt.order_by(Persons.id).limit(limit).offset(offset)
+        ),
+    }
+
     class Config:
         orm_mode = True
 
@@ -26,11 +34,41 @@ class Person(BaseModel, Crud[Persons]):
     name: str = None
 
 
+class Items(Base, Crud):
+    __tablename__ = "items"
+    __table_args__ = (sa.UniqueConstraint("code", name="uq_items_code"),)
+    id = sa.Column(sa.Integer, primary_key=True)
+    code = sa.Column(sa.String, nullable=False)
+    name = sa.Column(sa.String)
+
+
+class Item(BaseModel, Crud[Items]):
+    class Config:
+        orm_mode = True
+
+    code: str
+    name: str = None
+
+
+class Labels(Base, Crud):
+    __tablename__ = "labels"
+    id = sa.Column(sa.Integer, primary_key=True)
+    label = sa.Column("name", sa.String)
+
+
+class Label(BaseModel, Crud[Labels]):
+    class Config:
+        orm_mode = True
+
+    id: int = None
+    label: str = None
+
+
 class Parents(Base, Crud):
     __tablename__ = "parents"
     id = sa.Column(sa.Integer, primary_key=True)
     name = sa.Column(sa.String)
-    children = relationship("Children")
+    children = relationship("Children", back_populates="parent")
 
     def abcd(self):
         pass
@@ -43,6 +81,17 @@ class Children(Base, Crud):
     parent_id = sa.Column(
         sa.Integer, sa.ForeignKey("parents.id", onupdate="CASCADE", ondelete="CASCADE")
     )
+    parent = relationship("Parents", back_populates="children")
+    toys = relationship("Toys")
+
+
+class Toys(Base, Crud):
+    __tablename__ = "toys"
+    id = sa.Column(sa.Integer, primary_key=True)
+    name = sa.Column(sa.String)
+    child_id = sa.Column(
+        sa.Integer, sa.ForeignKey("children.id", onupdate="CASCADE", ondelete="CASCADE")
+    )
 
 
 class ChildrenSchema(BaseModel, Crud[Children]):
@@ -55,6 +104,8 @@ class ChildrenSchema(BaseModel, Crud[Children]):
 
 
 class ParentSchema(BaseModel, Crud[Parents]):
+    __queries__ = {"by_name": lambda stmt, name: stmt.where(Parents.name == name)}
+
     class Config:
         orm_mode = True
 
@@ -63,6 +114,45 @@ class ParentSchema(BaseModel, Crud[Parents]):
     children: list[ChildrenSchema]
 
 
+class ToySchema(BaseModel, Crud[Toys]):
+    class Config:
+        orm_mode = True
+
+    name: str
+
+
+class ChildTreeSchema(BaseModel, Crud[Children]):
+    class Config:
+        orm_mode = True
+
+    id: int
+    name: str
+    toys: list[ToySchema]
+
+
+class ParentTreeSchema(BaseModel, Crud[Parents]):
+    class Config:
+        orm_mode = True
+
+    id: int
+    children: list[ChildTreeSchema]
+
+
+class ParentNameSchema(BaseModel, Crud[Parents]):
+    class Config:
+        orm_mode = True
+
+    name: str
+
+
+class ChildWithParentSchema(BaseModel, Crud[Children]):
+    class Config:
+        orm_mode = True
+
+    id: int
+    parent: ParentNameSchema
+
+
 @pytest.fixture(scope="session")
 def db_config():
     host = os.getenv("POSTGRES_HOST", "127.0.0.1")
@@ -115,8 +205,8 @@ async def db(db_engine):
         INITIALIZED = True
 
     async with create_session() as session:
-        for table in {Persons, Parents, Children}:
-            stmt = delete(Persons)
+        for table in [Persons, Items, Labels, Toys, Children, Parents]:
+            stmt = delete(table)
             result = await session.execute(stmt)
         await session.commit()
 
@@ -181,3 +271,412 @@ async def test_foreign_key(db):
     assert parent4
     assert isinstance(parent4, ParentSchema)
     assert parent4.children
+
+
+@pytest.mark.docker
+@pytest.mark.asyncio
+async def test_create_returning(db):
+    from sqlalchemy import inspect
+
+    person = await Persons.crud(db).create(name="test_create")
+    assert isinstance(person, Persons)
+    assert inspect(person).detached
+    assert person.id
+
+    parent = await ParentSchema.crud(db).create(name="parent_1")
+    assert isinstance(parent, ParentSchema)
+    assert parent.children == []
+
+
+@pytest.mark.docker
+@pytest.mark.asyncio
+async def test_update_delete_returning(db):
+    assert await Person.crud(db).update_or_pass(id=-1, name="missing") is None
+    assert await Person.crud(db).delete_or_pass(id=-1) == 0
+
+    parent = await ParentSchema.crud(db).create(name="parent_1")
+    updated = await ParentSchema.crud(db).update(id=parent.id, name="parent_2")
+    assert isinstance(updated, ParentSchema)
+    assert updated.name == "parent_2"
+    assert await ParentSchema.crud(db).delete(id=parent.id) == 1
+
+
+@pytest.mark.docker
+@pytest.mark.asyncio
+async def test_create_many(db):
+    rows = [Person(name="person_1"), {"name": "person_2"}, {"name": "person_3"}]
+    created = await Person.crud(db).create_many(rows, chunk_size=2)
+    assert [x.name for x in created] == ["person_1", "person_2", "person_3"]
+    assert all(isinstance(x, Person) for x in created)
+
+    count = await Persons.crud(db).create_many(
+        ({"name": f"bulk_{i}"} for i in range(10)), returning=False, chunk_size=3
+    )
+    assert count == 10
+    assert len(await Persons.crud(db).all()) == 13
+
+    parents = await ParentSchema.crud(db).create_many(
+        [{"name": "parent_1"}, {"name": "parent_2"}]
+    )
+    assert [x.name for x in parents] == ["parent_1", "parent_2"]
+    assert all(x.children == [] for x in parents)
+
+
+@pytest.mark.docker
+@pytest.mark.asyncio
+async def test_update_delete_many(db):
+    created = await Persons.crud(db).create_many(
+        [{"name": f"person_{i}"} for i in range(6)]
+    )
+    ids = [x.id for x in created]
+
+    rows = [
+        {"id": ids[0], "name": "a"},
+        {"id": ids[1], "name": None},
+        {"id": -1, "name": "missing"},
+    ]
+    assert await Person.crud(db).update_many(rows, chunk_size=2) == 2
+    assert await Person.crud(db).update_many(
+        [Person(id=ids[2], name="c")], returning=True
+    ) == [{"id": ids[2]}]
+    names = [x.name for x in await Person.crud(db).get_many(ids[:3])]
+    assert names == ["a", None, "c"]
+    with pytest.raises(ValueError):
+        await Person.crud(db).update_many([{"id": ids[0]}])
+
+    assert await Persons.crud(db).delete_many([ids[0], (ids[1],), -1]) == 2
+    deleted = await Persons.crud(db).delete_many([{"id": ids[2]}], returning=True)
+    assert deleted == [{"id": ids[2]}]
+
+    deleted = await Persons.crud(db).delete_where(
+        Persons.name == "person_3", returning=True
+    )
+    assert deleted == [{"id": ids[3]}]
+    assert await Persons.crud(db).delete_where(Persons.id.in_(ids)) == 2
+    with pytest.raises(ValueError):
+        await Persons.crud(db).delete_where()
+    assert await Persons.crud(db).count() == 0
+
+
+@pytest.mark.docker
+@pytest.mark.asyncio
+async def test_upsert(db):
+    created = await Persons.crud(db).upsert(id=1, name="test_create")
+    assert created.name == "test_create"
+
+    updated = await Persons.crud(db).upsert(id=1, name="test_update")
+    assert updated.id == 1
+    assert updated.name == "test_update"
+    assert len(await Persons.crud(db).all()) == 1
+
+    rows = [{"code": f"code_{i}", "name": f"name_{i}"} for i in range(5)]
+    items = await Item.crud(db).upsert_many(
+        rows, constraint="uq_items_code", chunk_size=2
+    )
+    assert [x.code for x in items] == [x["code"] for x in rows]
+
+    rows = [{"code": "code_0", "name": "renamed"}, {"code": "code_9", "name": "new"}]
+    items = await Item.crud(db).upsert_many(rows, index_elements=["code"])
+    assert [(x.code, x.name) for x in items] == [
+        ("code_0", "renamed"),
+        ("code_9", "new"),
+    ]
+    assert len(await Items.crud(db).all()) == 6
+
+
+@pytest.mark.docker
+@pytest.mark.asyncio
+async def test_attribute_key(db):
+    # 属性名とカラム名が異なる場合も属性名で値を渡し、属性名で返す
+    for schema in [Labels, Label]:
+        created = await schema.crud(db).create(label="created")
+        assert created.label == "created"
+        updated = await schema.crud(db).update(id=created.id, label="updated")
+        assert updated.label == "updated"
+        upserted = await schema.crud(db).upsert(id=created.id, label="upserted")
+        assert upserted.label == "upserted"
+        rows = [{"id": created.id, "label": "updated_many"}]
+        assert await schema.crud(db).update_many(rows) == 1
+        assert (await schema.crud(db).get(created.id)).label == "updated_many"
+
+    # リレーションの値は書き込まない
+    parent = ParentSchema(id=0, name="parent", children=[])
+    created = await ParentSchema.crud(db).create(parent)
+    assert (created.name, created.children) == ("parent", [])
+    created.name = "upserted"
+    assert await ParentSchema.crud(db).upsert(created) == created
+
+
+@pytest.mark.docker
+@pytest.mark.asyncio
+async def test_batch_writer(db, db_engine):
+    engine, create_session = db_engine
+    async with BatchWriter(Person, create_session) as writer:
+        results = await asyncio.gather(
+            writer.create(name="created"),
+            writer.upsert(id=5, name="a"),
+            writer.upsert(id=5, name="b"),
+        )
+
+    # 同じキーへのupsertが同じバッチに含まれても、衝突せずに順に書き込む
+    assert [x.name for x in results] == ["created", "a", "b"]
+    assert writer.batches == 1
+    assert (await Person.crud(db).get(5)).name == "b"
+
+
+@pytest.mark.docker
+@pytest.mark.asyncio
+async def test_copy_in(db):
+    async def generate():
+        for i in range(5):
+            yield {"name": f"async_{i}"}
+
+    rows = [Person(name="person_1"), {"name": "person_2"}, ("person_3",)]
+    assert await Person.crud(db).copy_in(rows, chunk_size=2) == 3
+    assert await Persons.crud(db).copy_in(generate()) == 5
+    assert await Persons.crud(db).count() == 8
+
+    await db.rollback()
+    assert await Persons.crud(db).count() == 0
+
+    rows = [{"code": f"code_{i}", "name": f"name_{i}"} for i in range(3)]
+    assert await Item.crud(db).copy_in(rows) == 3
+    rows = [Item(code="code_0", name="renamed"), ("code_9", "new")]
+    assert await Item.crud(db).copy_in(rows, constraint="uq_items_code") == 2
+    items = await Item.crud(db).all(query_builder=lambda x: x.order_by(Items.code))
+    assert [(x.code, x.name) for x in items] == [
+        ("code_0", "renamed"),
+        ("code_1", "name_1"),
+        ("code_2", "name_2"),
+        ("code_9", "new"),
+    ]
+
+    # 同じトランザクションで一時テーブルを繰り返し使える
+    await Item.crud(db).copy_in([("code_1", "again")], index_elements=["code"])
+    assert await Item.crud(db).exists(code="code_1", name="again")
+
+    count = await Persons.crud(db).copy_in([(100, "id")], columns=["id", "name"])
+    assert count == 1
+    assert (await Persons.crud(db).get(100)).name == "id"
+
+
+@pytest.mark.docker
+@pytest.mark.asyncio
+async def test_seek(db):
+    await Persons.crud(db).create_many(
+        [{"name": f"person_{i % 3}"} for i in range(7)], returning=False
+    )
+
+    names = []
+    after = None
+    while True:
+        page = await Person.crud(db).seek(after=after, limit=3, order_by=["-name"])
+        names.extend(x.name for x in page["result"])
+        after = page["next"]
+        if after is None:
+            break
+
+    assert len(names) == 7
+    assert names == sorted(names, reverse=True)
+
+    # スキーマが宣言していないカラムで並べても、カーソルの値は遅延読み込みしない
+    await Parents.crud(db).create_many([{"name": f"parent_{i}"} for i in range(3)])
+    page = await ParentTreeSchema.crud(db).seek(limit=2, order_by=["-name"])
+    assert page["count"] == 2 and page["next"] is not None
+    page = await ParentTreeSchema.crud(db).seek(after=page["next"], order_by=["-name"])
+    assert page["count"] == 1 and page["next"] is None
+
+    page = await Person.crud(db).pagenate(page=1, per_page=5)
+    assert page["count"] == 5
+    assert "total" not in page
+
+
+@pytest.mark.docker
+@pytest.mark.asyncio
+async def test_exists_count(db):
+    persons = await Person.crud(db).create_many(
+        [{"name": f"count_{i}"} for i in range(7)]
+    )
+    crud = Person.crud(db)
+
+    assert await crud.exists(id=persons[0].id)
+    assert not await crud.exists(id=-1)
+    assert await crud.exist(persons[0].id)
+    assert await crud.exists(name="count_3")
+    assert not await crud.exists(Persons.name == "count_3", id=persons[0].id)
+
+    assert await crud.count() == 7
+    assert await crud.count(Persons.name.in_(["count_1", "count_2"])) == 2
+    assert await crud.count(estimate=True) >= 0
+
+    page = await crud.pagenate(page=2, per_page=5, with_total=True)
+    assert page["count"] == 2
+    assert page["total"] == 7
+
+    page = await crud.split(
+        limit=1,
+        query_builder=lambda stmt: stmt.where(Persons.name != "count_0"),
+        with_total=True,
+    )
+    assert page["count"] == 1
+    assert page["total"] == 6
+
+
+@pytest.mark.docker
+@pytest.mark.asyncio
+async def test_query(db):
+    await Persons.crud(db).create_many([{"name": f"person_{i}"} for i in range(5)])
+    await ParentSchema.crud(db).create(name="parent")
+
+    persons = await Person.crud(db).query("by_name", name="person_1")
+    assert [x.name for x in persons] == ["person_1"]
+    assert all(isinstance(x, Person) for x in persons)
+    persons = await Person.crud(db).query("page", limit=2, offset=1)
+    assert [x.name for x in persons] == ["person_1", "person_2"]
+
+    parents = await ParentSchema.crud(db).query("by_name", name="parent")
+    assert [(x.name, x.children) for x in parents] == [("parent", [])]
+
+    with pytest.raises(TypeError):
+        await Person.crud(db).query("by_name", nam="person_1")
+    with pytest.raises(KeyError):
+        await Person.crud(db).query("unknown")
+
+
+@pytest.mark.docker
+@pytest.mark.asyncio
+async def test_stream(db):
+    await Persons.crud(db).create_many(
+        [{"name": f"person_{i}"} for i in range(25)], returning=False
+    )
+
+    names = [x.name async for x in Person.crud(db).stream(chunk_size=10)]
+    assert sorted(names) == sorted(f"person_{i}" for i in range(25))
+
+    async for x in Persons.crud(db).stream(Persons.name == "person_3"):
+        assert isinstance(x, Persons)
+        assert x.name == "person_3"
+
+
+@pytest.mark.docker
+@pytest.mark.asyncio
+async def test_projection(db):
+    created = await Persons.crud(db).create(name="test_projection")
+
+    result = await Person.crud(db).all()
+    assert [x.name for x in result] == ["test_projection"]
+    assert isinstance(await Person.crud(db).get(created.id), Person)
+    assert len(db.identity_map) == 0
+
+
+@pytest.mark.docker
+@pytest.mark.asyncio
+async def test_get_many(db):
+    persons = await Persons.crud(db).create_many([{"name": "a"}, {"name": "b"}])
+    a, b = persons
+
+    result = await Person.crud(db).get_many([b.id, a.id])
+    assert [x.name for x in result] == ["b", "a"]
+
+    result = await Persons.crud(db).get_many_or_none([{"id": a.id}, (-1,)])
+    assert result[0].name == "a"
+    assert result[1] is None
+
+    with pytest.raises(KeyError) as e:
+        await Person.crud(db).get_many([a.id, -1])
+    assert e.value.args[0] == [-1]
+
+
+@pytest.mark.docker
+@pytest.mark.asyncio
+async def test_get_batch(db):
+    import asyncio
+
+    persons = await Persons.crud(db).create_many([{"name": "a"}, {"name": "b"}])
+    queries = []
+
+    @sa.event.listens_for(db.bind.sync_engine, "before_cursor_execute")
+    def count(conn, cursor, statement, parameters, context, executemany):
+        queries.append(statement)
+
+    try:
+        crud = Person.crud(db, batch=True)
+        result = await asyncio.gather(
+            crud.get(persons[0].id),
+            crud.get_or_none(-1),
+            Person.crud(db, batch=True).get(persons[1].id),
+        )
+    finally:
+        sa.event.remove(db.bind.sync_engine, "before_cursor_execute", count)
+
+    assert [x and x.name for x in result] == ["a", None, "b"]
+    assert len(queries) == 1
+
+
+@pytest.mark.docker
+@pytest.mark.asyncio
+async def test_nested_relationship(db):
+    parent = await Parents.crud(db).create(name="parent_1")
+    for i in range(2):
+        child = await Children.crud(db).create(name=f"child_{i}", parent_id=parent.id)
+        await Toys.crud(db).create_many(
+            [{"name": f"toy_{i}_{j}", "child_id": child.id} for j in range(2)]
+        )
+
+    queries = []
+
+    @sa.event.listens_for(db.bind.sync_engine, "before_cursor_execute")
+    def count(conn, cursor, statement, parameters, context, executemany):
+        queries.append(statement)
+
+    try:
+        tree = await ParentTreeSchema.crud(db).get(parent.id)
+        trees = await ParentTreeSchema.crud(db).all()
+        children = await ChildWithParentSchema.crud(db).all()
+    finally:
+        sa.event.remove(db.bind.sync_engine, "before_cursor_execute", count)
+
+    assert sorted(x.name for x in tree.children) == ["child_0", "child_1"]
+    assert sorted(len(x.toys) for x in tree.children) == [2, 2]
+    assert trees == [tree]
+    assert [x.parent.name for x in children] == ["parent_1", "parent_1"]
+
+    # 親・子・孫をそれぞれ１クエリで取得し、多対一は結合で取得する
+    assert len(queries) == 3 + 3 + 1
+    assert all("parents.name" not in x for x in queries[:6])
+
+
+@pytest.mark.docker
+@pytest.mark.asyncio
+async def test_prepare_all(db, db_config):
+    from sqlalchemy14 import create_engine, prepare_all
+
+    assert Person in registry.schemas
+    registry.invalidate()
+    assert registry.cache_stats().currsize == 0
+
+    # 他のテストでコンパイル済みのキャッシュを使わないよう、新しいエンジンで確認する
+    host, name, user, pw, port = db_config
+    connection_string = f"postgresql+asyncpg://{user}:{pw}@{host}:{port}/{name}"
+    async_engine, create_session = create_engine(connection_string)
+    engine = async_engine.sync_engine
+    prepare_all(async_engine)
+    compiled = len(engine._compiled_cache)
+    stats = registry.cache_stats()
+    assert stats.currsize > 0
+
+    try:
+        async with create_session() as db:
+            created = await Person.crud(db).create(name="test_prepare")
+            await Person.crud(db).get(created.id)
+            await Person.crud(db).all()
+            await Person.crud(db).query("by_name", name="test_prepare")
+            await Person.crud(db).update(id=created.id, name="test_update")
+            await Person.crud(db).delete(id=created.id)
+            await ParentSchema.crud(db).get_or_none(-1)
+    finally:
+        await async_engine.dispose()
+
+    assert len(engine._compiled_cache) == compiled
+    assert registry.cache_stats().misses == stats.misses
+    assert registry.cache_info()["sqlalchemy14.analyzer.analyze"].hits > 0
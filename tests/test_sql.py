@@ -1,6 +1,7 @@
 # type: ignore
 from dataclasses import dataclass
 
+import pytest
 import sqlalchemy as sa
 from pydantic import BaseModel
 from sqlalchemy.orm import declarative_base
@@ -17,6 +18,15 @@ class PersonEntity(Base):
     name = sa.Column(sa.String)
 
 
+class ItemEntity(Base):
+    __tablename__ = "items"
+    __table_args__ = (sa.UniqueConstraint("code", name="uq_items_code"),)
+
+    id = sa.Column(sa.Integer, primary_key=True)
+    code = sa.Column(sa.String)
+    name = sa.Column(sa.String)
+
+
 class Person(BaseModel):
     __entity__ = PersonEntity
     id: int
@@ -89,3 +99,151 @@ def test_model_filter():
     assert str(update) == "UPDATE persons SET "
     assert str(delete) == "DELETE FROM persons"
     # fmt: on
+
+
+def test_insert_keys():
+    from sqlalchemy14.analyzer import get_insert_keys
+
+    insert = get_insert_keys(PersonFilter)
+
+    # fmt: off
+    assert str(insert) == "INSERT INTO persons (id, name) VALUES (:id, :name) RETURNING persons.id"
+    # fmt: on
+
+
+def test_update_delete_returning():
+    from sqlalchemy14.analyzer import (
+        get_delete_keys,
+        get_update_keys,
+        get_update_returning,
+    )
+
+    update = get_update_returning(Person).values(name="a")
+    update_keys = get_update_keys(PersonFilter).values(name="a")
+    delete = get_delete_keys(PersonFilter)
+
+    # fmt: off
+    assert str(update) == "UPDATE persons SET name=:name RETURNING persons.id, persons.name"
+    assert str(update_keys) == "UPDATE persons SET name=:name RETURNING persons.id"
+    assert str(delete) == "DELETE FROM persons RETURNING persons.id"
+    # fmt: on
+
+
+def test_insert_many():
+    insert = Sql(Person).insert_many([{"name": "a"}, {"name": "b"}])
+
+    # fmt: off
+    assert str(insert) == "INSERT INTO persons (name) VALUES (:name_m0), (:name_m1) RETURNING persons.id, persons.name"
+    # fmt: on
+
+
+def test_iter_chunks():
+    from sqlalchemy14.builder import iter_chunks
+
+    rows = [{"id": 1, "name": "a"}, {"id": 2, "name": "b"}, {"id": 3, "name": "c"}]
+    assert [len(x) for x in iter_chunks(rows, 2, 1000)] == [2, 1]
+    assert [len(x) for x in iter_chunks(rows, 1000, 4)] == [2, 1]
+
+    rows = [{"name": "a"}, {"id": 2, "name": "b"}, {"id": 3, "name": "c"}]
+    assert [len(x) for x in iter_chunks(rows, 1000, 1000)] == [1, 2]
+
+
+def test_upsert():
+    from sqlalchemy.dialects import postgresql, sqlite
+
+    upsert = Sql(Person).upsert(id=1, name="a")
+    upsert_constraint = Sql(ItemEntity).upsert(
+        constraint="uq_items_code", code="a", name="b"
+    )
+    upsert_sqlite = Sql(ItemEntity).upsert_many(
+        [{"code": "a", "name": "b"}], index_elements=["code"], dialect_name="sqlite"
+    )
+    upsert_nothing = Sql(Person).upsert(id=1)
+
+    # fmt: off
+    assert str(upsert.compile(dialect=postgresql.dialect())) == "INSERT INTO persons (id, name) VALUES (%(id)s, %(name)s) ON CONFLICT (id) DO UPDATE SET name = excluded.name RETURNING persons.id, persons.name"
+    assert str(upsert_constraint.compile(dialect=postgresql.dialect())) == "INSERT INTO items (code, name) VALUES (%(code)s, %(name)s) ON CONFLICT ON CONSTRAINT uq_items_code DO UPDATE SET name = excluded.name RETURNING items.id, items.code, items.name"
+    assert str(upsert_sqlite.compile(dialect=sqlite.dialect())) == "INSERT INTO items (code, name) VALUES (?, ?) ON CONFLICT (code) DO UPDATE SET name = excluded.name"
+    assert str(upsert_nothing.compile(dialect=postgresql.dialect())) == "INSERT INTO persons (id) VALUES (%(id)s) ON CONFLICT (id) DO UPDATE SET id = excluded.id RETURNING persons.id, persons.name"
+    # fmt: on
+
+
+def test_cursor():
+    from datetime import datetime
+    from decimal import Decimal
+
+    from sqlalchemy14.cursor import decode_cursor, encode_cursor
+
+    values = [1, "a", None, datetime(2021, 4, 1, 12, 30), Decimal("1.5")]
+    assert decode_cursor(encode_cursor(values)) == values
+
+    with pytest.raises(ValueError):
+        decode_cursor("invalid")
+
+
+def test_seek_condition():
+    from sqlalchemy14.builder import get_seek_condition
+
+    asc = [(PersonEntity.name, False), (PersonEntity.id, False)]
+    mixed = [(PersonEntity.name, True), (PersonEntity.id, False)]
+
+    # fmt: off
+    assert str(get_seek_condition(asc, ["a", 1])) == "(persons.name, persons.id) > (:param_1, :param_2)"
+    assert str(get_seek_condition(mixed, ["a", 1])) == "persons.name < :name_1 OR persons.name = :name_2 AND persons.id > :id_1"
+    # fmt: on
+
+
+def test_select_columns():
+    from sqlalchemy14.analyzer import get_get_columns, get_select_columns
+
+    # fmt: off
+    assert str(get_select_columns(Person)) == "SELECT persons.id, persons.name \nFROM persons"
+    assert str(get_select_columns(PersonFilter)) == "SELECT persons.name, persons.id \nFROM persons"
+    assert str(get_get_columns(PersonFilter)) == "SELECT persons.name, persons.id \nFROM persons \nWHERE persons.id = :id"
+    # fmt: on
+
+
+def test_exists_count():
+    from sqlalchemy14.analyzer import get_count, get_exists
+
+    # fmt: off
+    assert str(get_exists(Person)) == "SELECT EXISTS (SELECT persons.id \nFROM persons \nWHERE persons.id = :id) AS anon_1"
+    assert str(get_count(Person)) == "SELECT count(*) AS count_1 \nFROM persons"
+    # fmt: on
+
+
+def test_update_from_arrays():
+    from sqlalchemy.dialects.postgresql.asyncpg import dialect
+
+    from sqlalchemy14.analyzer import get_update_from_arrays
+
+    stmt = get_update_from_arrays(Person, ("name",))
+    assert stmt is get_update_from_arrays(Person, ("name",))
+
+    # fmt: off
+    assert str(stmt.compile(dialect=dialect())) == "UPDATE persons SET name=_values.name FROM unnest(CAST(%s AS INTEGER[]), CAST(%s AS VARCHAR[])) AS _values(id, name) WHERE persons.id = _values.id RETURNING persons.id"
+    # fmt: on
+
+
+def test_statement_shapes():
+    from sqlalchemy14.analyzer import (
+        STATEMENT_SHAPES_MAXSIZE,
+        get_delete_by_keys,
+        get_insert,
+        get_update_returning,
+        get_update_shape,
+        get_values_shape,
+    )
+
+    insert = get_values_shape(get_insert, Person, frozenset(["name"]))
+    assert insert is get_values_shape(get_insert, Person, frozenset(["name"]))
+    assert get_values_shape.cache_info().maxsize == STATEMENT_SHAPES_MAXSIZE
+
+    update = get_update_shape(get_update_returning, Person, frozenset(["name"]))
+    delete = get_delete_by_keys(Person)
+
+    # fmt: off
+    assert str(insert) == "INSERT INTO persons (name) VALUES (:name) RETURNING persons.id, persons.name"
+    assert str(update) == "UPDATE persons SET name=:name WHERE persons.id = :_key_id RETURNING persons.id, persons.name"
+    assert str(delete) == "DELETE FROM persons WHERE persons.id = :_key_id RETURNING persons.id"
+    # fmt: on
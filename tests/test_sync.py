@@ -0,0 +1,101 @@
+import asyncio
+
+import pytest
+import sqlalchemy as sa
+from pydantic import BaseModel
+
+from sqlalchemy14 import Crud, create_sync_engine, get_pool_metrics
+
+R = sa.orm.registry()
+Base = R.generate_base()
+
+
+class Jobs(Base, Crud):
+    __tablename__ = "jobs"
+    id = sa.Column(sa.Integer, primary_key=True)
+    name = sa.Column(sa.String)
+
+
+class Job(BaseModel, Crud[Jobs]):
+    __queries__ = {"by_name": lambda stmt, name: stmt.where(Jobs.name == name)}
+
+    class Config:
+        orm_mode = True
+
+    id: int = None
+    name: str = None
+
+
+@pytest.fixture
+def db():
+    engine, create_session = create_sync_engine("sqlite://")
+    R.metadata.create_all(engine)
+    with create_session() as db:
+        yield db
+    engine.dispose()
+
+
+def test_sync_crud(db):
+    with pytest.raises(RuntimeError):
+        asyncio.get_running_loop()
+
+    created = Job.crud_sync(db).create(name="a")
+    assert isinstance(created, Job)
+    assert Job.crud_sync(db).get(created.id) == created
+    assert Job.crud_sync(db).exist(created.id)
+
+    updated = Job.crud_sync(db).update(id=created.id, name="b")
+    assert updated.name == "b"
+
+    Job.crud_sync(db).create_many([{"name": str(i)} for i in range(5)])
+    assert Job.crud_sync(db).count() == 6
+    assert [x.name for x in Job.crud_sync(db).get_many([created.id])] == ["b"]
+    assert Job.crud_sync(db).query("by_name", name="b") == [updated]
+
+    page = Job.crud_sync(db).pagenate(page=2, per_page=4, with_total=True)
+    assert page["count"] == 2
+    assert page["total"] == 6
+
+    names = [x.name for x in Job.crud_sync(db).stream(chunk_size=2)]
+    assert sorted(names) == sorted(["b", *(str(i) for i in range(5))])
+
+    assert Job.crud_sync(db).delete(id=created.id) == 1
+    assert Job.crud_sync(db).get_or_none(created.id) is None
+    with pytest.raises(KeyError):
+        Job.crud_sync(db).get(created.id)
+
+
+def test_sync_many(db):
+    ids = [x.id for x in Job.crud_sync(db).create_many([{"name": "a"}] * 4)]
+
+    rows = [{"id": ids[0], "name": "b"}, {"id": ids[1], "name": "c"}]
+    assert Job.crud_sync(db).update_many(rows) == 2
+    assert Job.crud_sync(db).update_many([{"id": -1, "name": "d"}]) == 0
+    with pytest.raises(ValueError):
+        Job.crud_sync(db).update_many([{"id": ids[0]}])
+    rows = [{"id": ids[2], "name": "d"}, {"id": -1, "name": "d"}]
+    assert Job.crud_sync(db).update_many(rows, returning=True) == [{"id": ids[2]}]
+    assert [x.name for x in Job.crud_sync(db).get_many(ids)] == ["b", "c", "d", "a"]
+
+    assert Job.crud_sync(db).delete_many([ids[0], -1]) == 1
+    assert Job.crud_sync(db).delete_many([ids[1]], returning=True) == [{"id": ids[1]}]
+    assert Job.crud_sync(db).delete_where(Jobs.name == "d", returning=True) == [
+        {"id": ids[2]}
+    ]
+    assert Job.crud_sync(db).delete_where(Jobs.name == "a") == 1
+    assert Job.crud_sync(db).count() == 0
+
+
+def test_sync_entity(db):
+    created = Jobs.crud_sync(db).create(name="a")
+    assert isinstance(created, Jobs)
+    assert [x.name for x in Jobs.crud_sync(db).all()] == ["a"]
+    assert Jobs.crud_sync(db).get.__doc__ == Jobs.crud(db).get.__doc__
+
+
+def test_sync_engine():
+    engine, create_session = create_sync_engine("sqlite://")
+    with create_session() as db:
+        assert db.execute(sa.text("select 1")).scalar() == 1
+    assert get_pool_metrics(engine).checkouts == 1
+    engine.dispose()
@@ -0,0 +1,134 @@
+import asyncio
+
+import pytest
+import sqlalchemy as sa
+from pydantic import BaseModel
+
+from sqlalchemy14 import BatchWriter, Crud, create_engine
+
+R = sa.orm.registry()
+Base = R.generate_base()
+
+
+class Events(Base, Crud):
+    __tablename__ = "events"
+    id = sa.Column(sa.Integer, primary_key=True)
+    name = sa.Column(sa.String)
+
+
+class Event(BaseModel, Crud[Events]):
+    class Config:
+        orm_mode = True
+
+    id: int = None
+    name: str = None
+
+
+@pytest.fixture
+async def create_session():
+    engine, create_session = create_engine("sqlite+aiosqlite://")
+    async with engine.begin() as conn:
+        await conn.run_sync(R.metadata.create_all)
+    yield create_session
+    await engine.dispose()
+
+
+@pytest.mark.asyncio
+async def test_batch_writer(create_session):
+    async with BatchWriter(Event, create_session, max_batch_size=4) as writer:
+        created = await asyncio.gather(
+            *(writer.create(name=str(i)) for i in range(10)),
+            writer.upsert(id=1, name="upserted"),
+        )
+
+    # 要求はまとめて書き込まれ、それぞれの呼び出し元に挿入した行が返る
+    assert [x.name for x in created[:10]] == [str(i) for i in range(10)]
+    assert created[10] == Event(id=1, name="upserted")
+    assert writer.batches == 3
+
+    async with create_session() as db:
+        assert await Event.crud(db).count() == 10
+        assert (await Event.crud(db).get(1)).name == "upserted"
+
+    with pytest.raises(RuntimeError):
+        await writer.create(name="closed")
+
+
+@pytest.mark.asyncio
+async def test_duplicate_upsert(create_session):
+    async with BatchWriter(Event, create_session) as writer:
+        upserted = await asyncio.gather(
+            writer.upsert(id=5, name="a"),
+            writer.upsert(id=6, name="b"),
+            writer.upsert(id=5, name="c"),
+        )
+
+    # 同じキーへのupsertは別の文で順に書き込み、それぞれの呼び出し元にその時点の行が返る
+    assert [(x.id, x.name) for x in upserted] == [(5, "a"), (6, "b"), (5, "c")]
+    assert writer.batches == 1
+
+    batch = [("upsert", {"id": x}, None) for x in [1, 2, 1, 1, None, None]]
+    assert [len(x) for op, x in writer.split(batch)] == [2, 1, 3]
+
+
+@pytest.mark.asyncio
+async def test_stopped(create_session):
+    # 誤った衝突対象は要求を受け付ける前にエラーにする
+    with pytest.raises(KeyError):
+        BatchWriter(Event, create_session, constraint="missing")
+    with pytest.raises(KeyError):
+        BatchWriter(Event, create_session, index_elements=["missing"])
+
+    # まとめる途中で失敗しても呼び出し元に例外を送出し、書き込みを続ける
+    writer = BatchWriter(Event, create_session)
+    split = writer.split
+    writer.split = lambda batch: 1 / 0
+    with pytest.raises(ZeroDivisionError):
+        await asyncio.wait_for(writer.upsert(id=1, name="a"), 1)
+    writer.split = split
+    assert (await writer.upsert(id=1, name="a")).name == "a"
+
+    # 書き込みのタスクが停止していれば、待機し続けずにエラーにする
+    writer.task.cancel()
+    await asyncio.sleep(0)
+    with pytest.raises(RuntimeError):
+        await asyncio.wait_for(writer.create(name="b"), 1)
+
+
+@pytest.mark.asyncio
+async def test_latency(create_session):
+    writer = BatchWriter(Event, create_session, max_latency=0.01)
+    first = asyncio.create_task(writer.create(name="a"))
+    await asyncio.sleep(0.05)
+    # 件数に達しなくても待機時間を過ぎれば書き込む
+    assert first.done()
+    assert (await first).name == "a"
+
+    second = await writer.create(name="b")
+    assert second.name == "b"
+    assert writer.batches == 2
+    await writer.close()
+
+
+@pytest.mark.asyncio
+async def test_backpressure(create_session):
+    writer = BatchWriter(Event, create_session, max_pending=2, max_latency=0.01)
+    tasks = [asyncio.create_task(writer.create(name=str(i))) for i in range(5)]
+    await asyncio.sleep(0)
+    assert writer.queue.qsize() == 2
+
+    await writer.close()
+    assert [(await x).name for x in tasks] == [str(i) for i in range(5)]
+
+
+@pytest.mark.asyncio
+async def test_error(create_session):
+    async with BatchWriter(Event, create_session) as writer:
+        results = await asyncio.gather(
+            writer.create(name="a"), writer.create(unknown="x"), return_exceptions=True
+        )
+
+    # 書き込みに失敗したバッチの呼び出し元には全て例外が送出される
+    assert all(isinstance(x, TypeError) for x in results)
+    async with create_session() as db:
+        assert await Event.crud(db).count() == 0